@@ -0,0 +1,206 @@
+# Single-handle access to GPT disks and images (for Python 3)
+# USAGE: see gpt_reader.py
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import mmap
+import errno
+import fcntl
+import stat
+
+from gpt_metrics import NULL_METRICS
+from gpt_compressed import compression_format
+from gpt_compressed import CompressedSource
+from gpt_container import container_format
+from gpt_container import open_container
+from gpt_container import is_sparse
+from gpt_container import SparseSource
+
+
+# ioctl for logical sector size of block device (linux/fs.h)
+BLKSSZGET=0x1268
+# O_DIRECT reads are aligned to memory page, it is enough for any sector size
+DIRECT_ALIGNMENT=mmap.PAGESIZE
+
+
+
+# opens a device or image once and serves all reads through it
+# reads return memoryviews, so slicing them for headers and
+# entries does not make new copies of the data
+class DiskSource( object ):
+    DISK_PATH=None
+    # size of the device or image in bytes
+    size=0
+    # O_DIRECT is used for reads, so they do not go through page cache
+    direct=False
+    # offsets of reads are offsets on the disk, so repairs can write there
+    writable=True
+
+    # fd of the opened device or image
+    _fd=None
+    # read-only mapping of the whole disk (only with use_mmap)
+    _mmap=None
+    _view=None
+    # aligned buffer for O_DIRECT reads, reused by every read
+    _buffer=None
+    # collector of read counters (gpt_metrics)
+    metrics=NULL_METRICS
+
+    # with direct=True reads bypass page cache (O_DIRECT)
+    # files which do not support it are read buffered,
+    # and their pages are dropped from cache after reading
+    def __init__( self, disk_path, use_mmap=False, direct=False, metrics=NULL_METRICS ):
+        self.DISK_PATH=disk_path
+        self.metrics=metrics
+        self.direct=direct
+        self.drop_cache=direct
+        if direct:
+            try:
+                self._fd=os.open(disk_path, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                if e.errno!=errno.EINVAL:
+                    raise
+                self.direct=False
+        if self._fd is None:
+            self._fd=os.open(disk_path, os.O_RDONLY)
+        try:
+            # fstat gives zero size for block devices, seeking does not
+            self.size=os.lseek(self._fd, 0, os.SEEK_END)
+            if use_mmap and not direct and self.size>0:
+                self._mmap=mmap.mmap(self._fd, self.size, access=mmap.ACCESS_READ)
+                self._view=memoryview(self._mmap)
+        except OSError:
+            # some devices can not be mapped - pread still works for them
+            self._mmap=None
+            self._view=None
+
+    # logical sector size of block device or None for images
+    def logical_block_size( self ):
+        if not stat.S_ISBLK(os.fstat(self._fd).st_mode):
+            return None
+        try:
+            result=fcntl.ioctl(self._fd, BLKSSZGET, bytes(4))
+        except OSError:
+            return None
+        return int.from_bytes(result, "little")
+
+    # every read is one pread
+    def cheap_read( self, offset, length ):
+        return True
+
+    # returns memoryview with length bytes from offset
+    # view can be shorter than length at the end of the disk
+    def read( self, offset, length ):
+        if offset<0:
+            raise ValueError("Negative offset "+str(offset)+" on "+self.DISK_PATH)
+        self.metrics.io("read", offset, length)
+        if self._view is not None:
+            return self._view[offset:offset+length]
+        if self.direct:
+            try:
+                return self.read_direct(offset, length)
+            except OSError as e:
+                if e.errno!=errno.EINVAL:
+                    raise
+                # file system accepted O_DIRECT flag but can not read with it
+                self.reopen_buffered()
+        data=os.pread(self._fd, length, offset)
+        if self.drop_cache:
+            os.posix_fadvise(self._fd, offset, length, os.POSIX_FADV_DONTNEED)
+        return memoryview(data)
+
+    # O_DIRECT read: offset and length are extended to aligned ones,
+    # data is read into reusable aligned buffer and requested part is copied out
+    def read_direct( self, offset, length ):
+        start=offset-offset%DIRECT_ALIGNMENT
+        end=min(offset+length, self.size)
+        if end<=offset:
+            return memoryview(b'')
+        aligned_length=-(-(end-start)//DIRECT_ALIGNMENT)*DIRECT_ALIGNMENT
+        if self._buffer is None or len(self._buffer)<aligned_length:
+            if self._buffer is not None:
+                self._buffer.close()
+            # anonymous mapping is always page aligned
+            self._buffer=mmap.mmap(-1, aligned_length)
+        with memoryview(self._buffer) as buffer:
+            got=os.preadv(self._fd, [buffer[0:aligned_length]], start)
+            return memoryview(bytes(buffer[offset-start:min(end-start, got)]))
+
+    # gives fd of the disk to other source and forgets it, O_DIRECT
+    # is switched off, because other sources read unaligned ranges
+    def detach( self ):
+        fd=self._fd
+        if self.direct:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+            self.direct=False
+        self._fd=None
+        self.close()
+        return fd
+
+    def reopen_buffered( self ):
+        os.close(self._fd)
+        self._fd=os.open(self.DISK_PATH, os.O_RDONLY)
+        self.direct=False
+
+    def close( self ):
+        if self._view is not None:
+            self._view.release()
+            self._view=None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # views are still used by headers and partitions,
+                # mapping will be released together with them
+                pass
+            self._mmap=None
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer=None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd=None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+
+
+# format of compressed image or container ("gzip", "qcow2", ...) or None for raw disks
+# read(offset, length) gives bytes of the disk, only its first bytes
+# and the last sector (fixed VHD has only footer there) are read
+def image_format( read, size ):
+    magic=bytes(read(0, 8))
+    return compression_format(magic) or container_format(magic, bytes(read(max(0, size-512), 8)))
+
+
+
+# opens the right source for the disk: DiskSource for devices and raw
+# images, CompressedSource for gzip/xz/zstd images, container sources
+# for qcow2/VHD/VHDX and SparseSource for sparse raw images
+# the disk is opened once: format is found by reads of DiskSource
+# (aligned O_DIRECT ones with direct=True) and other sources take its fd
+def open_disk_source( disk_path, use_mmap=False, direct=False, metrics=NULL_METRICS ):
+    source=DiskSource(disk_path, use_mmap, direct, metrics)
+    try:
+        magic=bytes(source.read(0, 8))
+        # fixed VHD has only footer in the last sector
+        footer=bytes(source.read(max(0, source.size-512), 8))
+    except Exception:
+        source.close()
+        raise
+    format=compression_format(magic)
+    if format is not None:
+        return CompressedSource(disk_path, format, metrics, source.detach())
+    format=container_format(magic, footer)
+    if format is not None:
+        return open_container(disk_path, format, metrics, source.detach())
+    if not use_mmap and not direct and is_sparse(disk_path):
+        return SparseSource(disk_path, metrics, source.detach())
+    return source
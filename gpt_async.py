@@ -0,0 +1,271 @@
+# Scanning many GPT disks with deadlines (asyncio, for Python 3)
+# USAGE: sudo python3 gpt_async.py [-j JOBS] [-c PER_CONTROLLER] [-a ABANDONED] [-t READ_TIMEOUT]
+#                                  [-T DISK_TIMEOUT] [-s] [-f PATHS_FILE] [DISK_PATH|GLOB ...]
+# Prints one JSON line per disk as gpt_fleet.py does. Reads of every disk run in
+# a bounded thread pool, disks behind the same controller (SCSI/ATA host,
+# NVMe controller, or file system of images) share a small number of reads
+# at once. A disk which does not answer in time gets partial record, for
+# example with primary header and "timeouts":["secondary"], and the scan goes on.
+# Disks which were never read before their deadline get "timeouts":["queued"]
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import re
+import sys
+import json
+import stat
+import asyncio
+import argparse
+import concurrent.futures
+
+from gpt_reader import DiskScan
+from gpt_fleet import collect_paths
+from gpt_fleet import header_record
+from gpt_fleet import partition_record
+from gpt_report import GptError
+from gpt_report import NotGptDiskError
+
+
+
+# path component of the controller in sysfs device path
+CONTROLLER_PATTERN=re.compile(r"^(host\d+|ata\d+|nvme\d+|usb\d+|virtio\d+)$")
+
+
+
+# key of controller of the disk: sysfs path of its host adapter for block
+# devices, device of the file system for images
+def controller_key( disk_path ):
+    st=os.stat(disk_path)
+    if not stat.S_ISBLK(st.st_mode):
+        return "dev:"+str(st.st_dev)
+    device=os.path.realpath("/sys/dev/block/%d:%d" % (os.major(st.st_rdev), os.minor(st.st_rdev)))
+    parts=device.split("/")
+    for i, part in enumerate(parts):
+        if CONTROLLER_PATTERN.match(part):
+            return "/".join(parts[0:i+1])
+    return os.path.dirname(device)
+
+
+
+# read step of one disk did not finish before its deadline
+# future is the step still running in its thread (None if it never started)
+class StepTimeout( Exception ):
+
+    def __init__( self, future=None ):
+        Exception.__init__(self)
+        self.future=future
+
+
+
+# calls function in the loop from a thread, if the loop still runs
+def call_in_loop( loop, function ):
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(function)
+
+
+
+# waits for semaphore until deadline (loop time), returns False if it is too late
+async def acquire( semaphore, deadline ):
+    loop=asyncio.get_running_loop()
+    try:
+        await asyncio.wait_for(semaphore.acquire(), max(0, deadline-loop.time()))
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+
+# runs blocking steps of disk scans in a thread pool with limits:
+# every controller has at most per_controller running steps. A step which
+# times out gives its controller slot back at once, so healthy disks behind
+# the same controller go on, but its thread keeps one of workers slots
+# until it really returns. Pool has workers threads, so hung steps
+# can take only the threads which are left after active steps
+class DeadlineExecutor( object ):
+
+    def __init__( self, executor, workers, per_controller=2 ):
+        self.executor=executor
+        self.per_controller=per_controller
+        # {controller key:asyncio.Semaphore}
+        self.controllers=dict()
+        # running and abandoned threads of the pool
+        self.threads=asyncio.Semaphore(workers)
+
+    def semaphore( self, controller ):
+        semaphore=self.controllers.get(controller)
+        if semaphore is None:
+            semaphore=self.controllers[controller]=asyncio.Semaphore(self.per_controller)
+        return semaphore
+
+    # runs function(*args) in the pool and returns (concurrent future, result)
+    # read_timeout counts from the start of the step in a thread,
+    # deadline (loop time) counts waiting for controller and pool too
+    # raises StepTimeout, the step can still be running then
+    async def run( self, controller, read_timeout, deadline, function, *args ):
+        loop=asyncio.get_running_loop()
+        semaphore=self.semaphore(controller)
+        if not await acquire(semaphore, deadline):
+            raise StepTimeout()
+        if not await acquire(self.threads, deadline):
+            semaphore.release()
+            raise StepTimeout()
+
+        # controller slot is given back once: by timeout or by the end of the step
+        released=[ ]
+        def release_controller( ):
+            if not released:
+                released.append(True)
+                semaphore.release()
+        def finished( future ):
+            call_in_loop(loop, release_controller)
+            call_in_loop(loop, self.threads.release)
+
+        started=asyncio.Event()
+        def step( ):
+            call_in_loop(loop, started.set)
+            return function(*args)
+        future=self.executor.submit(step)
+        future.add_done_callback(finished)
+        try:
+            await asyncio.wait_for(started.wait(), max(0, deadline-loop.time()))
+        except asyncio.TimeoutError:
+            # step which is still queued must not open the disk later
+            if future.cancel():
+                raise StepTimeout()
+        try:
+            return future, await asyncio.wait_for(asyncio.wrap_future(future),
+                                                  max(0, min(read_timeout, deadline-loop.time())))
+        except asyncio.TimeoutError:
+            release_controller()
+            raise StepTimeout(future)
+
+
+
+# opens disk and checks protective MBR
+def open_step( disk ):
+    disk.open()
+    disk.verify()
+
+
+
+# scans one disk step by step, every step with its own deadline
+# returns record as gpt_fleet.scan_disk does, and "timeouts" with names
+# of steps which did not finish; disk of hung read is closed by its thread
+async def scan_disk( limits, disk_path, search_secret=False, read_timeout=5.0, disk_timeout=30.0 ):
+    loop=asyncio.get_running_loop()
+    started=loop.time()
+    deadline=started+disk_timeout
+    record={"path":disk_path, "gpt":False}
+    disk=DiskScan(disk_path, search_secret)
+    # future of the step which hangs, disk is closed when it returns
+    hung=None
+    try:
+        controller=controller_key(disk_path)
+        try:
+            hung, _ = await limits.run(controller, read_timeout, deadline, open_step, disk)
+            hung=None
+        except StepTimeout as e:
+            hung=e.future
+            record["timeouts"]=["open" if hung is not None else "queued"]
+            return record
+        record["gpt"]=True
+        record["disk_sectors"]=disk.reader.DISK_SECTORS
+        record["lba_size"]=disk.reader.LBA_SIZE
+
+        headers=[ ]
+        timeouts=[ ]
+        for name, is_primary in (("primary", True), ("secondary", False)):
+            try:
+                hung, header = await limits.run(controller, read_timeout, deadline, disk.read_header, is_primary)
+                hung=None
+            except StepTimeout as e:
+                hung=e.future
+                timeouts.append(name)
+                # one hung read is enough, other reads of the disk would hang too
+                break
+            record[name]=header_record(header)
+            headers.append((header, is_primary))
+        # partitions are added here, not in the steps, thread of hung read must not change them
+        for header, is_primary in headers:
+            disk.add_partitions(header, is_primary)
+        record["partitions"]=[partition_record(p) for p in disk.reader.PARTITIONS_LIST.values()]
+        if timeouts:
+            record["timeouts"]=timeouts
+    except NotGptDiskError:
+        pass
+    except (OSError, ValueError, GptError) as e:
+        record["error"]=str(e)
+    except Exception as e:
+        # bug or unexpected format of one disk, the others are still scanned
+        record["error"]=type(e).__name__+": "+str(e)
+    finally:
+        record["elapsed"]=round(loop.time()-started, 6)
+        if hung is None:
+            disk.close()
+        else:
+            hung.add_done_callback(lambda f: disk.close())
+    return record
+
+
+
+# scans disks with at most jobs disks at once, yields records as they are ready
+# abandoned is number of threads of hung reads which can be left behind,
+# when they are all taken, new steps wait for them till their deadlines
+async def scan_disks( paths, search_secret=False, jobs=16, per_controller=2,
+                      read_timeout=5.0, disk_timeout=30.0, abandoned=16 ):
+    executor=concurrent.futures.ThreadPoolExecutor(max_workers=jobs+abandoned)
+    limits=DeadlineExecutor(executor, jobs+abandoned, per_controller)
+    disks=asyncio.Semaphore(jobs)
+
+    async def scan( path ):
+        async with disks:
+            return await scan_disk(limits, path, search_secret, read_timeout, disk_timeout)
+    try:
+        for task in asyncio.as_completed([scan(path) for path in paths]):
+            yield await task
+    finally:
+        # threads of hung reads are left behind, they must not block exit
+        executor.shutdown(wait=False)
+
+
+
+async def print_records( paths, options ):
+    async for record in scan_disks(paths, options.secret, options.jobs, options.per_controller,
+                                   options.read_timeout, options.disk_timeout, options.abandoned):
+        sys.stdout.write(json.dumps(record)+"\n")
+        sys.stdout.flush()
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Scan many GPT disks with deadlines and print NDJSON records.")
+    parser.add_argument("paths", nargs="*", help="disk paths or globs (/dev/sd?, images/*.img)")
+    parser.add_argument("-f", "--paths-file", help="file with one disk path or glob per line")
+    parser.add_argument("-j", "--jobs", type=int, default=16, help="number of disks scanned at once")
+    parser.add_argument("-c", "--per-controller", type=int, default=2,
+                        help="reads running at once on one controller")
+    parser.add_argument("-a", "--abandoned", type=int, default=16,
+                        help="threads of hung reads left behind before new reads wait for them")
+    parser.add_argument("-t", "--read-timeout", type=float, default=5.0, help="seconds for one read step")
+    parser.add_argument("-T", "--disk-timeout", type=float, default=30.0, help="seconds for the whole disk")
+    parser.add_argument("-s", "--secret", action="store_true",
+                        help="search for partitions hidden by gpt_secret_partition")
+    options=parser.parse_args(args[1:])
+
+    paths=collect_paths(options.paths, options.paths_file)
+    if not paths:
+        parser.print_usage()
+        exit(-1)
+    try:
+        asyncio.run(print_records(paths, options))
+    except KeyboardInterrupt:
+        pass
+    # hung reads can not be cancelled, do not wait for their threads
+    sys.stdout.flush()
+    os._exit(0)
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,179 @@
+# Benchmark of GPT utilities on synthetic images (for Python 3)
+# USAGE: python3 gpt_bench.py [-r REPEAT] [-d DISKS] [-j JOBS] [-b pread|mmap|direct] [--json]
+# Images are generated by gpt_image.py in temporary directory, no real device is touched
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+import gpt_fleet
+from gpt_reader import GptReader
+from gpt_image import make_image
+from gpt_secret_partition import hide_partition
+
+
+
+PHASES=("verify", "primary_read", "secondary_read", "entry_decode", "checksum", "hide")
+
+
+
+# (mean, median, 95th percentile) of timings in microseconds
+def summary( timings ):
+    timings=sorted(timings)
+    if not timings:
+        return {"mean_us":0.0, "p50_us":0.0, "p95_us":0.0}
+    return {
+        "mean_us":round(sum(timings)/len(timings)*1e6, 2),
+        "p50_us":round(timings[len(timings)//2]*1e6, 2),
+        "p95_us":round(timings[min(len(timings)-1, int(len(timings)*0.95))]*1e6, 2)
+    }
+
+
+
+def new_reader( path, backend, search_secret ):
+    return GptReader(path, search_secret, use_mmap=backend=="mmap", verbose=False,
+                     direct_io=backend=="direct")
+
+
+
+# runs every phase on one image repeat times, fresh reader each time
+# hide phase hides one partition and unhides it on the next repeat,
+# its undo journal is journal_path, not the journal directory of the user
+def bench_single( path, repeat, backend, journal_path ):
+    timings={phase:[ ] for phase in PHASES}
+    for i in range(repeat):
+        reader=new_reader(path, backend, True)
+        started=time.perf_counter()
+        reader.verify_gpt()
+        timings["verify"].append(time.perf_counter()-started)
+
+        started=time.perf_counter()
+        primary_header=reader.read_primary_gpt_header()
+        timings["primary_read"].append(time.perf_counter()-started)
+
+        started=time.perf_counter()
+        secondary_header=reader.read_secondary_gpt_header()
+        timings["secondary_read"].append(time.perf_counter()-started)
+
+        started=time.perf_counter()
+        reader.append_partitions_list(primary_header, True)
+        reader.append_partitions_list(secondary_header, False)
+        timings["entry_decode"].append(time.perf_counter()-started)
+
+        started=time.perf_counter()
+        primary_header.validate()
+        secondary_header.validate()
+        timings["checksum"].append(time.perf_counter()-started)
+
+        partition=next(iter(reader.PARTITIONS_LIST.values()), None)
+        if partition is not None:
+            started=time.perf_counter()
+            hide_partition(path, primary_header, secondary_header, partition, not partition.is_secret,
+                           journal_path=journal_path)
+            timings["hide"].append(time.perf_counter()-started)
+        reader.close()
+    return {phase:summary(timings[phase]) for phase in PHASES}
+
+
+
+# scans all images with gpt_fleet, returns number of scanned disks
+def scan_fleet( paths, jobs, backend ):
+    scanned=0
+    for record in gpt_fleet.scan_disks(paths, True, jobs, None, backend=="direct"):
+        scanned+=1
+    return scanned
+
+
+
+# scans all images with gpt_fleet, returns disks per second
+def bench_fleet( paths, jobs, backend ):
+    started=time.perf_counter()
+    scanned=scan_fleet(paths, jobs, backend)
+    elapsed=time.perf_counter()-started
+    return {"disks":scanned, "seconds":round(elapsed, 4),
+            "disks_per_second":round(scanned/max(elapsed, 1e-9), 1)}
+
+
+
+# peak of python allocations during function and max RSS of the process so far
+def traced_peak( function, *args ):
+    tracemalloc.start()
+    try:
+        function(*args)
+        current, peak=tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"python_peak_kib":peak//1024,
+            "max_rss_kib":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+
+# memory of single disk phases and of one fleet scan (tracemalloc slows
+# them down, so they are measured separately from the timings)
+# single disk runs first, so its max RSS does not include the fleet
+def bench_memory( paths, repeat, jobs, backend, journal_path ):
+    return {"single":traced_peak(bench_single, paths[0], repeat, backend, journal_path),
+            "fleet":traced_peak(scan_fleet, paths, jobs, backend)}
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Benchmark GPT utilities on synthetic images.")
+    parser.add_argument("-r", "--repeat", type=int, default=200, help="repeats of single disk phases")
+    parser.add_argument("-d", "--disks", type=int, default=200, help="number of images for fleet run")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="threads of fleet run")
+    parser.add_argument("-b", "--backend", choices=("pread", "mmap", "direct"), default="pread")
+    parser.add_argument("-s", "--size", type=int, default=1024, help="size of images in MiB")
+    parser.add_argument("-l", "--lba-size", type=int, default=512, help="logical sector size")
+    parser.add_argument("-n", "--entries", type=int, default=128, help="number of partition entries")
+    parser.add_argument("-e", "--entry-size", type=int, default=128, help="size of partition entry")
+    parser.add_argument("-p", "--partitions", type=int, default=8, help="partitions per image")
+    parser.add_argument("--hidden", type=int, default=1, help="hidden partitions per image")
+    parser.add_argument("--directory", default=None, help="where images are written (default: temporary)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    options=parser.parse_args(args[1:])
+
+    with tempfile.TemporaryDirectory(dir=options.directory) as directory:
+        paths=[ ]
+        for i in range(max(options.disks, 1)):
+            path=os.path.join(directory, "disk"+str(i)+".img")
+            make_image(path, options.size*1024*1024, options.lba_size, options.entries,
+                       options.entry_size, options.partitions, options.hidden, seed=i)
+            paths.append(path)
+
+        journal_path=os.path.join(directory, "bench.journal")
+        results={
+            "backend":options.backend,
+            "memory":bench_memory(paths, options.repeat, options.jobs, options.backend, journal_path),
+            "single":bench_single(paths[0], options.repeat, options.backend, journal_path),
+            "fleet":bench_fleet(paths, options.jobs, options.backend)
+        }
+
+    if options.json:
+        print(json.dumps(results))
+        return None
+    print("Backend: "+results["backend"])
+    print("\n%-16s %12s %12s %12s" % ("phase", "mean us", "p50 us", "p95 us"))
+    for phase in PHASES:
+        timing=results["single"][phase]
+        print("%-16s %12.2f %12.2f %12.2f" % (phase, timing["mean_us"], timing["p50_us"], timing["p95_us"]))
+    fleet=results["fleet"]
+    print("\nFleet: "+str(fleet["disks"])+" disks in "+str(fleet["seconds"])+" s, "
+          +str(fleet["disks_per_second"])+" disks/s")
+    for name, title in (("single", "Single disk"), ("fleet", "Fleet")):
+        memory=results["memory"][name]
+        print(title+": peak python memory "+str(memory["python_peak_kib"])+" KiB, max RSS "
+              +str(memory["max_rss_kib"])+" KiB")
+    return None
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,129 @@
+# Persistent cache of parsed GPT disks (for Python 3)
+# USAGE: see gpt_fleet.py --cache
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import json
+import stat
+import hashlib
+import threading
+import collections
+
+
+
+# default place of cache file: $XDG_CACHE_HOME/gptutils/tables.json
+def default_cache_path( ):
+    cache_home=os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "gptutils", "tables.json")
+
+
+
+# file of one disk in $XDG_CACHE_HOME/gptutils/<kind>, as journal or manifest
+# named by hash of absolute path, so /a_b and /a/b do not share one file
+def disk_cache_path( kind, disk_path, suffix ):
+    path=os.path.abspath(disk_path)
+    name=os.path.basename(path)+"-"+hashlib.sha256(os.fsencode(path)).hexdigest()[:32]
+    return os.path.join(os.path.dirname(default_cache_path()), kind, name+suffix)
+
+
+
+# identity of the disk: device, inode, size and modification time
+# block devices have zero size in stat, so size is passed by caller
+def disk_identity( disk_path, size, search_secret ):
+    st=os.stat(disk_path)
+    return "%d:%d:%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_rdev, size,
+                                  st.st_mtime_ns, int(search_secret))
+
+
+
+# cache of parsed disks keyed by disk identity
+# entry is valid only while primary header has the same stored
+# header and partition table checksums, so only LBA 1 is read to check it
+# least recently used entries are removed when there are more than max_entries
+class TableCache( object ):
+    CACHE_PATH=None
+    MAX_ENTRIES=4096
+
+    def __init__( self, cache_path=None, max_entries=4096 ):
+        self.CACHE_PATH=cache_path or default_cache_path()
+        self.MAX_ENTRIES=max_entries
+        # {identity:{"checksum", "entries_checksum", "record"}}, oldest first
+        self.entries=collections.OrderedDict()
+        self.changed=False
+        self.lock=threading.Lock()
+        self.check_path()
+        self.load()
+
+    # cache file replaces only regular files, so a disk path given
+    # by mistake is never overwritten
+    def check_path( self ):
+        try:
+            st=os.lstat(self.CACHE_PATH)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError("Cache file "+self.CACHE_PATH+" is not a regular file")
+
+    def load( self ):
+        try:
+            with open(self.CACHE_PATH) as file:
+                entries=json.load(file)
+        except (OSError, ValueError):
+            return
+        self.entries=collections.OrderedDict(entries)
+        self.evict()
+
+    # writes cache into temporary file and replaces the old one,
+    # so broken cache file is never seen by other runs
+    def save( self ):
+        with self.lock:
+            if not self.changed:
+                return
+            self.check_path()
+            directory=os.path.dirname(self.CACHE_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temporary=self.CACHE_PATH+"."+str(os.getpid())+".tmp"
+            with open(temporary,"w") as file:
+                json.dump(self.entries, file)
+            os.replace(temporary, self.CACHE_PATH)
+            self.changed=False
+
+    def evict( self ):
+        while len(self.entries)>self.MAX_ENTRIES:
+            self.entries.popitem(last=False)
+            self.changed=True
+
+    # returns cached record for disk of the reader or None
+    # reader must have opened source, only its LBA 1 is read
+    def lookup( self, reader ):
+        source=reader.open_source()
+        identity=disk_identity(reader.DISK_PATH, source.size, reader.SEARCH_SECRET)
+        with self.lock:
+            entry=self.entries.get(identity)
+        if entry is None:
+            return None
+        gpt_header=source.read(reader.LBA_SIZE, reader.LBA_SIZE)
+        if (gpt_header[0x10:0x10+4].hex()!=entry["checksum"]
+                or gpt_header[0x58:0x58+4].hex()!=entry["entries_checksum"]):
+            return None
+        with self.lock:
+            self.entries.move_to_end(identity)
+            self.changed=True
+        return dict(entry["record"])
+
+    # saves record of the disk, primary_header gives checksums to check it later
+    def store( self, reader, primary_header, record ):
+        identity=disk_identity(reader.DISK_PATH, reader.open_source().size, reader.SEARCH_SECRET)
+        entry={
+            "checksum":primary_header.checksum.hex(),
+            "entries_checksum":primary_header.entries_checksum.hex(),
+            "record":record
+        }
+        with self.lock:
+            self.entries[identity]=entry
+            self.entries.move_to_end(identity)
+            self.changed=True
+            self.evict()
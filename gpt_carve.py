@@ -0,0 +1,166 @@
+# Program for carving GPT headers from the whole disk (for Python 3)
+# USAGE: sudo python3 gpt_carve.py [-j PROCESSES] [-c CHUNK_MIB] DISK_PATH(/dev/sdX)
+# Searches every sector for "EFI PART" signature, so stale and relocated
+# headers and their partition tables are found too.
+# Prints one JSON line (NDJSON) per found header, progress goes to stderr
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import sys
+import errno
+import json
+import time
+import zlib
+import argparse
+import multiprocessing
+
+from disk_source import DiskSource
+from gpt_structures import GptHeader
+from gpt_structures import decode_partition_entries
+
+
+
+SIGNATURE=b"EFI PART"
+# bigger tables are treated as false positives
+MAX_TABLE_SIZE=16*1024*1024
+
+
+
+# checks header found at offset and partition table it points to
+# table is searched relative to the header, so relocated copies are checked too
+def validate_candidate( fd, offset, lba_size, disk_size ):
+    gpt_header=os.pread(fd, lba_size, offset)
+    header=GptHeader(gpt_header, offset, b'', None)
+    candidate={
+        "offset":offset,
+        "lba":offset//lba_size,
+        "current_lba":header.current_lba,
+        "backup_lba":header.backup_lba,
+        "entries_lba":header.entries_lba,
+        "entries_number":header.entries_number,
+        "entry_size":header.entry_size,
+        "relocated":header.current_lba*lba_size!=offset,
+        "checksum_ok":False,
+        "entries_checksum_ok":False
+    }
+    if header.header_size<92 or header.header_size>lba_size:
+        return candidate
+    candidate["checksum_ok"]=header.calculate_checksum(gpt_header)==bytes(header.checksum)
+
+    table_size=header.entries_number*header.entry_size
+    table_offset=offset+(header.entries_lba-header.current_lba)*lba_size
+    if (header.entry_size<128 or table_size==0 or table_size>MAX_TABLE_SIZE
+            or table_offset<0 or table_offset+table_size>disk_size):
+        return candidate
+    partition_table=os.pread(fd, table_size, table_offset)
+    candidate["partition_table_offset"]=table_offset
+    candidate["entries_checksum_ok"]=zlib.crc32(partition_table)==int.from_bytes(header.entries_checksum,"little")
+    entries=decode_partition_entries(partition_table, header.entry_size, header.entries_number, True)
+    candidate["partitions"]=len(entries)
+    candidate["secret_partitions"]=sum(1 for e in entries if e[3])
+    return candidate
+
+
+
+# searches signature in [start, end) of the disk, chunk by chunk
+# every read is extended by len(SIGNATURE)-1 bytes,
+# so signatures on the border of chunks and ranges are found once
+# runs in worker processes: returns (bytes scanned, candidates)
+def carve_range( task ):
+    disk_path, start, end, disk_size, chunk_size, lba_size, aligned = task
+    overlap=len(SIGNATURE)-1
+    buffer=bytearray(chunk_size+overlap)
+    candidates=[ ]
+    fd=os.open(disk_path, os.O_RDONLY)
+    try:
+        position=start
+        while position<end:
+            # holes of sparse images can not contain headers
+            try:
+                data=os.lseek(fd, position, os.SEEK_DATA)
+            except OSError as e:
+                # no data till the end of file
+                if e.errno==errno.ENXIO:
+                    break
+                data=position
+            if data>=end:
+                break
+            position=max(position, data-data%lba_size)
+
+            length=min(chunk_size, end-position)
+            view=memoryview(buffer)[0:min(length+overlap, disk_size-position)]
+            got=os.preadv(fd, [view], position)
+            chunk=buffer[0:got] if got<len(buffer) else buffer
+            found=chunk.find(SIGNATURE, 0, min(got, length+overlap))
+            while found!=-1 and found<length:
+                offset=position+found
+                if not aligned or offset%lba_size==0:
+                    candidates.append(validate_candidate(fd, offset, lba_size, disk_size))
+                found=chunk.find(SIGNATURE, found+1, min(got, length+overlap))
+            position+=length
+    finally:
+        os.close(fd)
+    return end-start, candidates
+
+
+
+# splits disk into ranges for worker processes
+# ranges are aligned to chunks so every read is aligned too
+def split_ranges( disk_size, range_size, chunk_size ):
+    range_size=max(chunk_size, range_size-range_size%chunk_size)
+    return [(start, min(start+range_size, disk_size)) for start in range(0, disk_size, range_size)]
+
+
+
+# yields (candidate or None, bytes done, total bytes) while ranges are finished
+def carve_disk( disk_path, processes=None, chunk_size=16*1024*1024,
+                range_size=1024*1024*1024, lba_size=512, aligned=True ):
+    with DiskSource(disk_path) as source:
+        disk_size=source.size
+    tasks=[(disk_path, start, end, disk_size, chunk_size, lba_size, aligned)
+           for start, end in split_ranges(disk_size, range_size, chunk_size)]
+    done=0
+    with multiprocessing.Pool(processes) as pool:
+        for scanned, candidates in pool.imap_unordered(carve_range, tasks):
+            done+=scanned
+            for candidate in candidates:
+                yield candidate, done, disk_size
+            yield None, done, disk_size
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Search the whole disk for GPT headers.")
+    parser.add_argument("disk", help="disk path (/dev/sdX) or image")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="number of worker processes")
+    parser.add_argument("-c", "--chunk", type=int, default=16, help="size of single read in MiB")
+    parser.add_argument("-r", "--range", type=int, default=1024, help="size of range for one worker task in MiB")
+    parser.add_argument("-l", "--lba-size", type=int, default=512, help="logical sector size")
+    parser.add_argument("-u", "--unaligned", action="store_true",
+                        help="report signatures which are not at the start of a sector")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not print progress")
+    options=parser.parse_args(args[1:])
+
+    started=time.monotonic()
+    found=0
+    for candidate, done, total in carve_disk(options.disk, options.processes,
+                                              options.chunk*1024*1024, options.range*1024*1024,
+                                              options.lba_size, not options.unaligned):
+        if candidate is not None:
+            found+=1
+            sys.stdout.write(json.dumps(candidate)+"\n")
+            sys.stdout.flush()
+        elif not options.quiet:
+            elapsed=max(time.monotonic()-started, 1e-9)
+            sys.stderr.write("\r%6.2f%%  %d/%d MiB  %.1f MiB/s  %d headers found" % (
+                100.0*done/max(total,1), done>>20, total>>20, done/elapsed/(1<<20), found))
+            sys.stderr.flush()
+    if not options.quiet:
+        sys.stderr.write("\n")
+    return None
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
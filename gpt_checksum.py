@@ -0,0 +1,110 @@
+# CRC32 routines for GPT headers and partition tables (for Python 3)
+# USAGE: see gpt_secret_partition.py
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import zlib
+
+
+
+# reflected CRC32 polynomial used by zlib and GPT
+CRC32_POLY=0xEDB88320
+# checksum field is zeroed while header checksum is calculated
+ZERO_CHECKSUM=bytes(4)
+
+
+
+# a*b modulo CRC polynomial (same as multmodp() in zlib)
+def multmodp( a, b ):
+    m=1<<31
+    p=0
+    while True:
+        if a & m:
+            p^=b
+            if (a & (m-1))==0:
+                break
+        m>>=1
+        b=(b>>1)^CRC32_POLY if b & 1 else b>>1
+    return p
+
+# x^(2^n) modulo CRC polynomial
+X2N_TABLE=[1<<30]
+for n in range(1,32):
+    X2N_TABLE.append(multmodp(X2N_TABLE[n-1], X2N_TABLE[n-1]))
+
+# x^(n*2^k) modulo CRC polynomial (same as x2nmodp() in zlib)
+def x2nmodp( n, k ):
+    p=1<<31
+    while n:
+        if n & 1:
+            p=multmodp(X2N_TABLE[k & 31], p)
+        n>>=1
+        k+=1
+    return p
+
+
+
+# CRC32 of header with zeroed checksum field, no new header is built
+# with entries_checksum it is CRC32 of header with this partition table checksum
+def header_crc32( gpt_header, entries_checksum=None ):
+    header_size=int.from_bytes(gpt_header[0x0C:0x0C+4],"little")
+    crc=zlib.crc32(gpt_header[0:0x10])
+    crc=zlib.crc32(ZERO_CHECKSUM, crc)
+    if entries_checksum is None:
+        return zlib.crc32(gpt_header[0x14:header_size], crc)
+    crc=zlib.crc32(gpt_header[0x14:0x58], crc)
+    crc=zlib.crc32(entries_checksum, crc)
+    return zlib.crc32(gpt_header[0x5C:header_size], crc)
+
+
+
+# checks stored checksums of GptHeader without building any byte strings
+# returns (header checksum is correct, partition table checksum is correct)
+def validate_header( header ):
+    header_ok=header_crc32(header.gpt_header)==int.from_bytes(header.checksum,"little")
+    entries_ok=zlib.crc32(header.partition_table)==int.from_bytes(header.entries_checksum,"little")
+    return header_ok, entries_ok
+
+
+
+# keeps CRC32 of partition table up to date when single entries are replaced
+# CRC of every entry is calculated once and cached, new table CRC is
+# combined from the old one instead of hashing the whole table again
+class PartitionTableChecksum( object ):
+    partition_table=None
+    entry_size=None
+    # current CRC32 of the table with all updates
+    crc=None
+
+    def __init__( self, partition_table, entry_size ):
+        self.partition_table=memoryview(partition_table)
+        self.entry_size=entry_size
+        self.crc=zlib.crc32(self.partition_table)
+        # {entry index:CRC32 of current entry}
+        self.entry_crcs=dict()
+
+    def entry_crc( self, index ):
+        crc=self.entry_crcs.get(index)
+        if crc is None:
+            start=index*self.entry_size
+            crc=zlib.crc32(self.partition_table[start:start+self.entry_size])
+            self.entry_crcs[index]=crc
+        return crc
+
+    # replaces entry in checksum (table itself is not changed)
+    # returns new CRC32 of the table
+    def update_entry( self, index, new_entry ):
+        if len(new_entry)!=self.entry_size:
+            raise ValueError("Entry must be "+str(self.entry_size)+" bytes, not "+str(len(new_entry)))
+        old_crc=self.entry_crc(index)
+        new_crc=zlib.crc32(new_entry)
+        # bytes after the entry shift the difference of entry CRCs
+        suffix=len(self.partition_table)-(index+1)*self.entry_size
+        self.crc^=multmodp(x2nmodp(suffix,3), old_crc^new_crc)
+        self.entry_crcs[index]=new_crc
+        return self.crc
+
+    # checksum as it is stored in header
+    def checksum( self ):
+        return self.crc.to_bytes(4,"little")
@@ -0,0 +1,411 @@
+# Reading GPT from compressed disk images (for Python 3)
+# USAGE: sudo python3 gpt_reader.py IMAGE.img.gz (or .xz, .zst)
+# First read builds a seekable index of the image and saves it next to
+# the image (IMAGE.gptidx). Index keeps the beginning and the end of the
+# disk, where GPT lives, and starts of independent members/frames, so
+# later reads decompress only the part around requested bytes
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import json
+import errno
+import zlib
+import lzma
+import bisect
+
+from gpt_cache import disk_cache_path
+from gpt_metrics import NULL_METRICS
+
+# zstd is not in standard library
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# errors of broken streams, EOFError is raised for streams which end too early
+DECOMPRESSION_ERRORS=(zlib.error, lzma.LZMAError, EOFError)
+if zstandard is not None:
+    DECOMPRESSION_ERRORS+=(zstandard.ZstdError,)
+
+
+GZIP_MAGIC=b"\x1f\x8b"
+XZ_MAGIC=b"\xfd7zXZ\x00"
+ZSTD_MAGIC=b"\x28\xb5\x2f\xfd"
+
+INDEX_VERSION=2
+INDEX_SUFFIX=".gptidx"
+# beginning and end of the disk kept in index, enough for 34 LBAs of
+# 4096 bytes and partition tables with a few thousands of entries
+WINDOW_SIZE=1024*1024
+# size of compressed reads
+READ_SIZE=1024*1024
+# uncompressed chunks are about this size, whatever the compression ratio is
+CHUNK_SIZE=1024*1024
+# read which decompresses at most this from a member start is cheap
+CHEAP_DISTANCE=16*1024*1024
+
+# zstd frame header sizes by flags of its descriptor byte
+ZSTD_DICT_ID_SIZES=(0, 1, 2, 4)
+ZSTD_CONTENT_SIZE_SIZES=(0, 2, 4, 8)
+ZSTD_RLE_BLOCK=1
+
+
+
+# format of compressed image by its magic or None
+def compression_format( magic ):
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(XZ_MAGIC):
+        return "xz"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+
+# decompressor of one zstd frame with max_length and needs_input of
+# lzma.LZMADecompressor. zstandard decompressobj returns all output of its
+# input at once, so input is given to it by whole blocks: every block
+# gives at most 128 KiB, even the 4-byte RLE ones
+class ZstdFrameDecompressor( object ):
+
+    def __init__( self ):
+        self.decompressor=zstandard.ZstdDecompressor().decompressobj()
+        # input which is not given to decompressor yet starts at position
+        self.input=b''
+        self.position=0
+        self.in_frame=False
+        # size of checksum after the last block
+        self.checksum=0
+        # frame ended, the rest of input is not parsed
+        self.ended=False
+        self.needs_input=True
+
+    @property
+    def eof( self ):
+        return self.decompressor.eof
+
+    @property
+    def unused_data( self ):
+        return self.input[self.position:]+self.decompressor.unused_data
+
+    # length of the next whole header or block at position, None if input
+    # does not have all of it yet
+    def next_length( self ):
+        data=self.input
+        position=self.position
+        left=len(data)-position
+        if self.ended:
+            return left or None
+        if not self.in_frame:
+            if left<5:
+                return None
+            if data[position:position+4]!=ZSTD_MAGIC:
+                # skippable frames have no blocks and give no output
+                self.ended=True
+                return left
+            descriptor=data[position+4]
+            single_segment=descriptor & 0x20
+            content_size=ZSTD_CONTENT_SIZE_SIZES[descriptor>>6] or (1 if single_segment else 0)
+            length=5+(0 if single_segment else 1)+ZSTD_DICT_ID_SIZES[descriptor & 3]+content_size
+            if left<length:
+                return None
+            self.in_frame=True
+            self.checksum=4 if descriptor & 4 else 0
+            return length
+        if left<3:
+            return None
+        header=int.from_bytes(data[position:position+3], "little")
+        length=3+(1 if (header>>1) & 3==ZSTD_RLE_BLOCK else header>>3)
+        if header & 1:
+            length+=self.checksum
+        if left<length:
+            return None
+        if header & 1:
+            self.ended=True
+        return length
+
+    def decompress( self, data, max_length ):
+        if data:
+            self.input=self.input[self.position:]+data
+            self.position=0
+        output=[ ]
+        size=0
+        self.needs_input=False
+        while size<max_length:
+            length=self.next_length()
+            if length is None:
+                self.needs_input=True
+                break
+            chunk=self.decompressor.decompress(self.input[self.position:self.position+length])
+            self.position+=length
+            output.append(chunk)
+            size+=len(chunk)
+            if self.decompressor.eof:
+                break
+        return b''.join(output)
+
+
+
+# decompressor of one gzip member, xz stream or zstd frame
+def new_decompressor( format ):
+    if format=="gzip":
+        return zlib.decompressobj(31)
+    if format=="xz":
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    if zstandard is None:
+        raise OSError("zstandard module is needed for zstd images")
+    return ZstdFrameDecompressor()
+
+
+
+# decompresses data in chunks of about CHUNK_SIZE, so 1 MiB of compressed
+# zeros does not become 1 GiB at once. zlib keeps the rest of input in
+# unconsumed_tail, lzma and zstd keep it inside until needs_input
+def decompress_chunks( decompressor, format, data ):
+    while True:
+        chunk=decompressor.decompress(data, CHUNK_SIZE)
+        if chunk:
+            yield chunk
+        if format=="gzip":
+            data=decompressor.unconsumed_tail
+            more=bool(data)
+        else:
+            data=b''
+            more=not decompressor.needs_input
+        if decompressor.eof or not more:
+            return
+
+
+
+# decompresses image from compressed offset, yields (uncompressed chunk, None)
+# and (b'', compressed offset) when the next member/frame starts
+# raises one of DECOMPRESSION_ERRORS for broken and truncated images
+def decompress( file, format, compressed_offset ):
+    decompressor=new_decompressor(format)
+    file.seek(compressed_offset)
+    # compressed offset of the start of next member, if previous one ended
+    member_start=None
+    offset=compressed_offset
+    while True:
+        data=file.read(READ_SIZE)
+        if not data:
+            if member_start is None:
+                raise EOFError("compressed stream ends early at "+str(offset))
+            return
+        data_offset=offset
+        offset+=len(data)
+        while data:
+            if member_start is not None:
+                # xz streams can be padded with zero bytes
+                if format=="xz":
+                    stripped=data.lstrip(b"\0")
+                    data_offset+=len(data)-len(stripped)
+                    data=stripped
+                    if not data:
+                        break
+                yield b'', data_offset
+                member_start=None
+            for chunk in decompress_chunks(decompressor, format, data):
+                yield chunk, None
+            if not decompressor.eof:
+                break
+            # member ended, rest of data belongs to the next one
+            rest=decompressor.unused_data
+            data_offset+=len(data)-len(rest)
+            data=rest
+            member_start=data_offset
+            decompressor=new_decompressor(format)
+
+
+
+# index of compressed image: size, checkpoints and head/tail windows
+class CompressedIndex( object ):
+    format=None
+    size=0
+    # [(uncompressed offset, compressed offset)] of independent members
+    checkpoints=None
+    head=b''
+    tail=b''
+    tail_offset=0
+
+    # one streaming pass over the whole image opened as file
+    @staticmethod
+    def build( file, format, window_size=WINDOW_SIZE ):
+        index=CompressedIndex()
+        index.format=format
+        index.checkpoints=[(0, 0)]
+        head=bytearray()
+        tail=bytearray()
+        size=0
+        for chunk, member_start in decompress(file, format, 0):
+            if member_start is not None:
+                index.checkpoints.append((size, member_start))
+                continue
+            if len(head)<window_size:
+                head+=chunk[0:window_size-len(head)]
+            tail+=chunk
+            if len(tail)>2*window_size:
+                del tail[0:len(tail)-window_size]
+            size+=len(chunk)
+        if len(tail)>window_size:
+            del tail[0:len(tail)-window_size]
+        index.size=size
+        index.head=bytes(head)
+        index.tail=bytes(tail)
+        index.tail_offset=size-len(tail)
+        return index
+
+    # index file: one JSON line, then head and tail bytes
+    def save( self, index_path, image_stat ):
+        header={
+            "version":INDEX_VERSION,
+            "format":self.format,
+            "compressed_size":image_stat.st_size,
+            "compressed_mtime_ns":image_stat.st_mtime_ns,
+            "size":self.size,
+            "checkpoints":self.checkpoints,
+            "head":len(self.head),
+            "tail":len(self.tail)
+        }
+        directory=os.path.dirname(os.path.abspath(index_path))
+        os.makedirs(directory, exist_ok=True)
+        temporary=index_path+"."+str(os.getpid())+".tmp"
+        with open(temporary,"wb") as file:
+            file.write(json.dumps(header).encode()+b"\n")
+            file.write(self.head)
+            file.write(self.tail)
+        os.replace(temporary, index_path)
+
+    # returns index or None if there is no index for this version of image
+    @staticmethod
+    def load( index_path, image_stat ):
+        try:
+            with open(index_path,"rb") as file:
+                header=json.loads(file.readline())
+                if (header.get("version")!=INDEX_VERSION
+                        or header["compressed_size"]!=image_stat.st_size
+                        or header["compressed_mtime_ns"]!=image_stat.st_mtime_ns):
+                    return None
+                index=CompressedIndex()
+                index.format=header["format"]
+                index.size=header["size"]
+                index.checkpoints=[tuple(c) for c in header["checkpoints"]]
+                index.head=file.read(header["head"])
+                index.tail=file.read(header["tail"])
+        except (OSError, ValueError, KeyError):
+            return None
+        index.tail_offset=index.size-len(index.tail)
+        return index
+
+
+
+# places where index of image is searched: next to the image and in cache
+def index_paths( image_path ):
+    return [image_path+INDEX_SUFFIX, disk_cache_path("index", image_path, INDEX_SUFFIX)]
+
+
+
+# DiskSource for compressed images, read-only
+class CompressedSource( object ):
+    DISK_PATH=None
+    size=0
+    direct=False
+    writable=False
+    metrics=NULL_METRICS
+
+    # fd is already opened image, source takes it over and closes it
+    def __init__( self, image_path, format, metrics=NULL_METRICS, fd=None ):
+        self.DISK_PATH=image_path
+        self.metrics=metrics
+        self.file=open(fd if fd is not None else image_path, "rb")
+        try:
+            self.open_index(format)
+        except Exception:
+            self.close()
+            raise
+
+    def open_index( self, format ):
+        image_path=self.DISK_PATH
+        image_stat=os.fstat(self.file.fileno())
+        self.index=None
+        for index_path in index_paths(image_path):
+            self.index=CompressedIndex.load(index_path, image_stat)
+            if self.index is not None:
+                break
+        if self.index is None:
+            try:
+                self.index=CompressedIndex.build(self.file, format)
+            except DECOMPRESSION_ERRORS as e:
+                raise self.broken(e)
+            # image directory can be read-only, then index goes to cache
+            for index_path in index_paths(image_path):
+                try:
+                    self.index.save(index_path, image_stat)
+                    break
+                except OSError:
+                    continue
+        self.size=self.index.size
+        self.starts=[c[0] for c in self.index.checkpoints]
+
+    def logical_block_size( self ):
+        return None
+
+    # true if read is in head/tail window or near start of a member; single-member
+    # gzip and xz have only the first one, so reads in the middle are not cheap
+    def cheap_read( self, offset, length ):
+        end=min(offset+length, self.size)
+        index=self.index
+        if end<=len(index.head) or offset>=index.tail_offset:
+            return True
+        return offset-self.starts[bisect.bisect_right(self.starts, offset)-1]<=CHEAP_DISTANCE
+
+    def read( self, offset, length ):
+        if offset<0:
+            raise ValueError("Negative offset "+str(offset)+" on "+self.DISK_PATH)
+        self.metrics.io("read", offset, length)
+        end=min(offset+length, self.size)
+        if end<=offset:
+            return memoryview(b'')
+        index=self.index
+        if end<=len(index.head):
+            return memoryview(index.head)[offset:end]
+        if offset>=index.tail_offset:
+            return memoryview(index.tail)[offset-index.tail_offset:end-index.tail_offset]
+        return memoryview(self.read_compressed(offset, end))
+
+    # decompresses from the nearest member before offset
+    def read_compressed( self, offset, end ):
+        uncompressed, compressed = self.index.checkpoints[bisect.bisect_right(self.starts, offset)-1]
+        result=bytearray()
+        try:
+            for chunk, member_start in decompress(self.file, self.index.format, compressed):
+                if member_start is not None:
+                    continue
+                chunk_end=uncompressed+len(chunk)
+                if chunk_end>offset:
+                    result+=chunk[max(0, offset-uncompressed):end-uncompressed]
+                uncompressed=chunk_end
+                if uncompressed>=end:
+                    break
+        except DECOMPRESSION_ERRORS as e:
+            raise self.broken(e)
+        return bytes(result)
+
+    # broken image is I/O error of the disk, as bad sector of real one
+    def broken( self, error ):
+        return OSError(errno.EIO, "Compressed image "+self.DISK_PATH+" is broken: "+(str(error) or type(error).__name__))
+
+    def close( self ):
+        if self.file is not None:
+            self.file.close()
+            self.file=None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
@@ -0,0 +1,487 @@
+# Reading GPT from virtual machine disks without conversion (for Python 3)
+# USAGE: sudo python3 gpt_reader.py DISK.qcow2 (or .vhd, .vhdx)
+# Guest LBAs are translated through qcow2 L1/L2 tables, VHD BAT and
+# VHDX BAT, only clusters with requested bytes are read.
+# Sparse raw images are read only where they have data (SEEK_DATA/SEEK_HOLE)
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+#               https://gitlab.com/qemu-project/qemu/-/blob/master/docs/interop/qcow2.txt
+#               https://learn.microsoft.com/en-us/windows/win32/vstor/about-vhd
+#               https://learn.microsoft.com/en-us/openspecs/windows_protocols/ms-vhdx
+
+import os
+import zlib
+import uuid
+import errno
+import struct
+import collections
+
+from gpt_metrics import NULL_METRICS
+
+# zstd compressed qcow2 clusters need zstandard module
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+
+QCOW2_MAGIC=b"QFI\xfb"
+VHD_COOKIE=b"conectix"
+VHDX_SIGNATURE=b"vhdxfile"
+
+# number of cached qcow2 L2 tables
+L2_CACHE_SIZE=64
+# limits of header fields, as qemu has them
+QCOW2_CLUSTER_BITS=(9, 21)
+QCOW2_MAX_L1_SIZE=32*1024*1024
+QCOW2_MAX_BACKING_FILE_SIZE=1023
+VHDX_BLOCK_SIZES=(1024*1024, 256*1024*1024)
+VHDX_SECTOR_SIZES=(512, 4096)
+VHDX_MAX_ENTRIES=2047
+
+
+
+# container format of the image by its first bytes and last sector
+def container_format( magic, footer ):
+    if magic.startswith(QCOW2_MAGIC):
+        return "qcow2"
+    if magic.startswith(VHDX_SIGNATURE):
+        return "vhdx"
+    # dynamic VHD has copy of footer at the start, fixed one only at the end
+    if magic.startswith(VHD_COOKIE) or footer.startswith(VHD_COOKIE):
+        return "vhd"
+    return None
+
+
+
+def is_power_of_two( value ):
+    return value>0 and value & (value-1)==0
+
+
+
+# base of container sources: guest disk is split into blocks (clusters),
+# every block is translated to file offset by subclass. Subclass sets size
+# and block_size and has read_block( block, within, length ), which returns
+# length bytes of guest block number block starting from offset within
+class ContainerSource( object ):
+    DISK_PATH=None
+    # virtual size of the disk
+    size=0
+    direct=False
+    # guest offsets are not file offsets, only raw sources can be written
+    writable=False
+    metrics=NULL_METRICS
+    # size of translated block (cluster) of the format
+    block_size=0
+    # logical sector size of virtual disk, if format stores it
+    sector_size=None
+
+    # fd is already opened image, source takes it over and closes it
+    def __init__( self, disk_path, metrics=NULL_METRICS, fd=None ):
+        self.DISK_PATH=disk_path
+        self.metrics=metrics
+        self._fd=fd if fd is not None else os.open(disk_path, os.O_RDONLY)
+        self.file_size=os.lseek(self._fd, 0, os.SEEK_END)
+
+    # runs open_image of subclass and closes the image if it is broken,
+    # fields too short for their structs are broken header as well
+    def open_checked( self ):
+        try:
+            self.open_image()
+        except struct.error as e:
+            self.close()
+            raise OSError(errno.EINVAL, "Broken header of "+self.DISK_PATH+": "+str(e))
+        except Exception:
+            self.close()
+            raise
+
+    # OSError for header field out of its range
+    def invalid( self, field, value ):
+        return OSError(errno.EINVAL, "Invalid "+field+" "+str(value)+" in "+self.DISK_PATH)
+
+    def logical_block_size( self ):
+        return self.sector_size
+
+    # every block is found through tables, without reading other blocks
+    def cheap_read( self, offset, length ):
+        return True
+
+    # reads beyond the end of the file are refused before the buffer
+    # is allocated, so broken tables sizes do not take all memory
+    def pread( self, length, offset ):
+        if offset+length>self.file_size:
+            raise OSError(errno.EIO, "Image "+self.DISK_PATH+" is truncated at "+str(offset))
+        data=os.pread(self._fd, length, offset)
+        if len(data)<length:
+            raise OSError(errno.EIO, "Image "+self.DISK_PATH+" is truncated at "+str(offset))
+        return data
+
+    def read( self, offset, length ):
+        if offset<0:
+            raise ValueError("Negative offset "+str(offset)+" on "+self.DISK_PATH)
+        self.metrics.io("read", offset, length)
+        end=min(offset+length, self.size)
+        parts=[ ]
+        position=offset
+        while position<end:
+            block, within = divmod(position, self.block_size)
+            part_length=min(self.block_size-within, end-position)
+            parts.append(self.read_block(block, within, part_length))
+            position+=part_length
+        return memoryview(b''.join(parts))
+
+    def close( self ):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd=None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+
+
+# qcow2 v2 and v3 images, with compressed clusters, extended L2 entries
+# and backing files. L1 table is read once, L2 tables are cached
+class Qcow2Source( ContainerSource ):
+    OFFSET_MASK=0x00fffffffffffe00
+    COMPRESSED=1<<62
+    ZERO=1
+
+    def __init__( self, disk_path, metrics=NULL_METRICS, fd=None ):
+        ContainerSource.__init__(self, disk_path, metrics, fd)
+        self.open_checked()
+
+    def open_image( self ):
+        header=self.pread(104, 0)
+        (magic, version, backing_file_offset, backing_file_size, cluster_bits, size,
+         crypt_method, l1_size, l1_table_offset) = struct.unpack_from(">4sIQIIQIIQ", header)
+        if version<2 or version>3:
+            raise OSError(errno.EINVAL, "Unsupported qcow2 version "+str(version)+" of "+self.DISK_PATH)
+        if crypt_method!=0:
+            raise OSError(errno.EINVAL, "Encrypted qcow2 image "+self.DISK_PATH+" is not supported")
+        if not QCOW2_CLUSTER_BITS[0]<=cluster_bits<=QCOW2_CLUSTER_BITS[1]:
+            raise self.invalid("qcow2 cluster_bits", cluster_bits)
+        self.cluster_bits=cluster_bits
+        self.block_size=1<<cluster_bits
+        self.size=size
+
+        incompatible=0
+        self.compression_type=0
+        if version==3:
+            incompatible=struct.unpack_from(">Q", header, 72)[0]
+            header_length=struct.unpack_from(">I", header, 100)[0]
+            if incompatible & (1<<3) and header_length>104:
+                self.compression_type=self.pread(1, 104)[0]
+        # external data file can not be read from this image
+        if incompatible & (1<<2):
+            raise OSError(errno.EINVAL, "qcow2 image "+self.DISK_PATH+" uses external data file")
+        # extended L2 entries have 32 subclusters with their own bitmap
+        self.extended_l2=bool(incompatible & (1<<4))
+        self.l2_entry_size=16 if self.extended_l2 else 8
+        self.l2_entries=self.block_size//self.l2_entry_size
+
+        # L1 table must cover the whole disk and be not bigger than qemu allows
+        if l1_size*8>QCOW2_MAX_L1_SIZE or l1_size<-(-size//(self.block_size*self.l2_entries)):
+            raise self.invalid("qcow2 l1_size", l1_size)
+        l1=self.pread(l1_size*8, l1_table_offset)
+        self.l1_table=struct.unpack(">"+str(l1_size)+"Q", l1)
+        self.l2_cache=collections.OrderedDict()
+
+        # unallocated clusters are read from backing file
+        self.backing=None
+        if backing_file_offset:
+            if backing_file_size>QCOW2_MAX_BACKING_FILE_SIZE:
+                raise self.invalid("qcow2 backing_file_size", backing_file_size)
+            name=os.fsdecode(self.pread(backing_file_size, backing_file_offset))
+            if not os.path.isabs(name):
+                name=os.path.join(os.path.dirname(os.path.abspath(self.DISK_PATH)), name)
+            self.backing=open_container_or_raw(name)
+
+    # (L2 entry, subcluster bitmap) of guest cluster
+    def l2_entry( self, cluster ):
+        l1_index, l2_index = divmod(cluster, self.l2_entries)
+        if l1_index>=len(self.l1_table):
+            return 0, 0
+        l2_offset=self.l1_table[l1_index] & self.OFFSET_MASK
+        if l2_offset==0:
+            return 0, 0
+        table=self.l2_cache.get(l2_offset)
+        if table is None:
+            table=self.pread(self.block_size, l2_offset)
+            self.l2_cache[l2_offset]=table
+            if len(self.l2_cache)>L2_CACHE_SIZE:
+                self.l2_cache.popitem(last=False)
+        else:
+            self.l2_cache.move_to_end(l2_offset)
+        if self.extended_l2:
+            return struct.unpack_from(">QQ", table, l2_index*16)
+        return struct.unpack_from(">Q", table, l2_index*8)[0], 0
+
+    def read_unallocated( self, block, within, length ):
+        position=block*self.block_size+within
+        if self.backing is not None and position<self.backing.size:
+            data=bytes(self.backing.read(position, length))
+            return data+bytes(length-len(data))
+        return bytes(length)
+
+    def read_compressed( self, entry ):
+        offset_bits=62-(self.cluster_bits-8)
+        host_offset=entry & ((1<<offset_bits)-1)
+        sectors=(entry>>offset_bits) & ((1<<(self.cluster_bits-8))-1)
+        compressed=os.pread(self._fd, (sectors+1)*512-(host_offset & 511), host_offset)
+        if self.compression_type==1:
+            if zstandard is None:
+                raise OSError(errno.EINVAL, "zstandard module is needed for "+self.DISK_PATH)
+            return zstandard.ZstdDecompressor().decompressobj().decompress(compressed)[0:self.block_size]
+        return zlib.decompressobj(-15).decompress(compressed, self.block_size)
+
+    def read_block( self, block, within, length ):
+        entry, bitmap = self.l2_entry(block)
+        if entry & self.COMPRESSED:
+            return self.read_compressed(entry)[within:within+length]
+        host_offset=entry & self.OFFSET_MASK
+        if not self.extended_l2:
+            if entry & self.ZERO:
+                return bytes(length)
+            if host_offset==0:
+                return self.read_unallocated(block, within, length)
+            return self.pread(length, host_offset+within)
+        # subclusters: low 32 bits are allocated ones, high 32 bits read as zeros
+        subcluster_size=self.block_size//32
+        parts=[ ]
+        position=within
+        while position<within+length:
+            subcluster=position//subcluster_size
+            part_length=min((subcluster+1)*subcluster_size, within+length)-position
+            if bitmap & (1<<(32+subcluster)):
+                parts.append(bytes(part_length))
+            elif bitmap & (1<<subcluster) and host_offset:
+                parts.append(self.pread(part_length, host_offset+position))
+            else:
+                parts.append(self.read_unallocated(block, position, part_length))
+            position+=part_length
+        return b''.join(parts)
+
+    def close( self ):
+        if getattr(self, "backing", None) is not None:
+            self.backing.close()
+            self.backing=None
+        ContainerSource.close(self)
+
+
+
+# fixed and dynamic VHD images, BAT is read once
+class VhdSource( ContainerSource ):
+    FIXED=2
+    DYNAMIC=3
+    DIFFERENCING=4
+    UNALLOCATED=0xFFFFFFFF
+
+    def __init__( self, disk_path, metrics=NULL_METRICS, fd=None ):
+        ContainerSource.__init__(self, disk_path, metrics, fd)
+        self.open_checked()
+
+    def open_image( self ):
+        footer=self.pread(512, max(0, self.file_size-512))
+        if not footer.startswith(VHD_COOKIE):
+            # footer of old images can be 511 bytes
+            footer=self.pread(512, 0)
+        data_offset, = struct.unpack_from(">Q", footer, 16)
+        self.size, = struct.unpack_from(">Q", footer, 48)
+        self.disk_type, = struct.unpack_from(">I", footer, 60)
+        if self.disk_type==self.FIXED:
+            self.block_size=1024*1024
+            return
+        if self.disk_type==self.DIFFERENCING:
+            raise OSError(errno.EINVAL, "Differencing VHD "+self.DISK_PATH+" is not supported")
+        if self.disk_type!=self.DYNAMIC:
+            raise OSError(errno.EINVAL, "Unknown VHD type "+str(self.disk_type)+" of "+self.DISK_PATH)
+
+        dynamic_header=self.pread(1024, data_offset)
+        if not dynamic_header.startswith(b"cxsparse"):
+            raise OSError(errno.EINVAL, "Broken dynamic VHD header of "+self.DISK_PATH)
+        table_offset, = struct.unpack_from(">Q", dynamic_header, 16)
+        max_table_entries, self.block_size = struct.unpack_from(">II", dynamic_header, 28)
+        if not is_power_of_two(self.block_size) or self.block_size<512:
+            raise self.invalid("VHD block size", self.block_size)
+        # BAT must cover the whole disk, its size is checked by pread
+        if max_table_entries<-(-self.size//self.block_size):
+            raise self.invalid("VHD max table entries", max_table_entries)
+        self.bat=struct.unpack(">"+str(max_table_entries)+"I", self.pread(max_table_entries*4, table_offset))
+        # every block starts with sector bitmap, padded to sector
+        self.bitmap_size=-(-self.block_size//(512*8*512))*512
+
+    def read_block( self, block, within, length ):
+        if self.disk_type==self.FIXED:
+            return self.pread(length, block*self.block_size+within)
+        if block>=len(self.bat) or self.bat[block]==self.UNALLOCATED:
+            return bytes(length)
+        return self.pread(length, self.bat[block]*512+self.bitmap_size+within)
+
+
+
+# VHDX images, BAT is read once
+# log must be already replayed (by Hyper-V or qemu-img check -r)
+class VhdxSource( ContainerSource ):
+    BAT_GUID=uuid.UUID("2DC27766-F623-4200-9D64-115E9BFD4A08").bytes_le
+    METADATA_GUID=uuid.UUID("8B7CA206-4790-4B9A-B8FE-575F050F886E").bytes_le
+    FILE_PARAMETERS_GUID=uuid.UUID("CAA16737-FA36-4D43-B3B6-33F0AA44E76B").bytes_le
+    VIRTUAL_DISK_SIZE_GUID=uuid.UUID("2FA54224-CD1B-4876-B211-5DBED83BF4B8").bytes_le
+    LOGICAL_SECTOR_SIZE_GUID=uuid.UUID("8141BF1D-A96F-4709-BA47-F233A8FAAB5F").bytes_le
+    # payload block states
+    FULLY_PRESENT=6
+    PARTIALLY_PRESENT=7
+
+    def __init__( self, disk_path, metrics=NULL_METRICS, fd=None ):
+        ContainerSource.__init__(self, disk_path, metrics, fd)
+        self.open_checked()
+
+    def open_image( self ):
+        # current header is valid one with bigger sequence number
+        headers=[ ]
+        for offset in (64*1024, 128*1024):
+            header=self.pread(4096, offset)
+            if header.startswith(b"head"):
+                headers.append(header)
+        if not headers:
+            raise OSError(errno.EINVAL, "There is no VHDX header in "+self.DISK_PATH)
+        header=max(headers, key=lambda h: struct.unpack_from("<Q", h, 8)[0])
+        if header[48:64]!=bytes(16):
+            raise OSError(errno.EINVAL, "VHDX log of "+self.DISK_PATH+" must be replayed first")
+
+        regions=self.pread(64*1024, 192*1024)
+        if not regions.startswith(b"regi"):
+            raise OSError(errno.EINVAL, "Broken VHDX region table of "+self.DISK_PATH)
+        entry_count, = struct.unpack_from("<I", regions, 8)
+        if entry_count>VHDX_MAX_ENTRIES:
+            raise self.invalid("VHDX region entry count", entry_count)
+        bat=metadata=None
+        for i in range(entry_count):
+            guid=regions[16+i*32:32+i*32]
+            file_offset, length = struct.unpack_from("<QI", regions, 32+i*32)
+            if guid==self.BAT_GUID:
+                bat=(file_offset, length)
+            elif guid==self.METADATA_GUID:
+                metadata=(file_offset, length)
+        if bat is None or metadata is None:
+            raise OSError(errno.EINVAL, "VHDX "+self.DISK_PATH+" has no BAT or metadata region")
+
+        items=self.read_metadata(*metadata)
+        self.block_size, flags = struct.unpack_from("<II", items[self.FILE_PARAMETERS_GUID])
+        if not is_power_of_two(self.block_size) or not VHDX_BLOCK_SIZES[0]<=self.block_size<=VHDX_BLOCK_SIZES[1]:
+            raise self.invalid("VHDX block size", self.block_size)
+        if flags & 2:
+            raise OSError(errno.EINVAL, "Differencing VHDX "+self.DISK_PATH+" is not supported")
+        self.size, = struct.unpack_from("<Q", items[self.VIRTUAL_DISK_SIZE_GUID])
+        self.sector_size, = struct.unpack_from("<I", items[self.LOGICAL_SECTOR_SIZE_GUID])
+        if self.sector_size not in VHDX_SECTOR_SIZES:
+            raise self.invalid("VHDX logical sector size", self.sector_size)
+        # after every chunk_ratio payload blocks BAT has sector bitmap entry
+        self.chunk_ratio=(1<<23)*self.sector_size//self.block_size
+        entries=bat[1]//8
+        self.bat=struct.unpack("<"+str(entries)+"Q", self.pread(entries*8, bat[0]))
+
+    # {item guid:item bytes} of metadata region
+    def read_metadata( self, file_offset, length ):
+        region=self.pread(length, file_offset)
+        if not region.startswith(b"metadata"):
+            raise OSError(errno.EINVAL, "Broken VHDX metadata of "+self.DISK_PATH)
+        entry_count, = struct.unpack_from("<H", region, 10)
+        if entry_count>VHDX_MAX_ENTRIES:
+            raise self.invalid("VHDX metadata entry count", entry_count)
+        items=dict()
+        for i in range(entry_count):
+            start=32+i*32
+            item_offset, item_length = struct.unpack_from("<II", region, start+16)
+            items[region[start:start+16]]=region[item_offset:item_offset+item_length]
+        for guid in (self.FILE_PARAMETERS_GUID, self.VIRTUAL_DISK_SIZE_GUID, self.LOGICAL_SECTOR_SIZE_GUID):
+            if guid not in items:
+                raise OSError(errno.EINVAL, "VHDX "+self.DISK_PATH+" misses required metadata")
+        return items
+
+    def read_block( self, block, within, length ):
+        index=block+block//self.chunk_ratio
+        entry=self.bat[index] if index<len(self.bat) else 0
+        state=entry & 7
+        if state==self.PARTIALLY_PRESENT:
+            raise OSError(errno.EINVAL, "Differencing VHDX "+self.DISK_PATH+" is not supported")
+        if state!=self.FULLY_PRESENT:
+            # not present, zero, unmapped and undefined blocks read as zeros
+            return bytes(length)
+        return self.pread(length, (entry>>20)*1024*1024+within)
+
+
+
+# raw sparse images: holes are not read, they are zeros
+class SparseSource( ContainerSource ):
+    writable=True
+
+    def __init__( self, disk_path, metrics=NULL_METRICS, fd=None ):
+        ContainerSource.__init__(self, disk_path, metrics, fd)
+        self.size=self.file_size
+        self.block_size=max(self.size, 1)
+
+    def read_block( self, block, within, length ):
+        parts=[ ]
+        position=within
+        end=within+length
+        while position<end:
+            try:
+                data=os.lseek(self._fd, position, os.SEEK_DATA)
+            except OSError as e:
+                # no data till the end of file
+                if e.errno!=errno.ENXIO:
+                    raise
+                data=end
+            data=min(data, end)
+            if data>position:
+                parts.append(bytes(data-position))
+                position=data
+                continue
+            hole=min(os.lseek(self._fd, position, os.SEEK_HOLE), end)
+            parts.append(self.pread(hole-position, position))
+            position=hole
+        return b''.join(parts)
+
+
+
+# true for regular files with less allocated blocks than their size
+def is_sparse( disk_path ):
+    st=os.stat(disk_path)
+    return os.path.isfile(disk_path) and st.st_blocks*512<st.st_size
+
+
+
+# container source by format or None for raw images
+# fd is already opened image which the source takes over
+def open_container( disk_path, format, metrics=NULL_METRICS, fd=None ):
+    if format=="qcow2":
+        return Qcow2Source(disk_path, metrics, fd)
+    if format=="vhdx":
+        return VhdxSource(disk_path, metrics, fd)
+    if format=="vhd":
+        return VhdSource(disk_path, metrics, fd)
+    return None
+
+
+
+# backing files of qcow2 can be any of the formats or raw,
+# format is found through the same descriptor the source uses
+def open_container_or_raw( disk_path ):
+    fd=os.open(disk_path, os.O_RDONLY)
+    try:
+        magic=os.pread(fd, 8, 0)
+        footer=os.pread(fd, 8, max(0, os.lseek(fd, 0, os.SEEK_END)-512))
+    except OSError:
+        os.close(fd)
+        raise
+    format=container_format(magic, footer)
+    if format is None:
+        return SparseSource(disk_path, fd=fd)
+    return open_container(disk_path, format, fd=fd)
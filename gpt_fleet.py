@@ -0,0 +1,174 @@
+# Program for scanning many GPT disks and images at once (for Python 3)
+# USAGE: sudo python3 gpt_fleet.py [-j JOBS] [-s] [-c] [--cache-file CACHE_FILE] [--cache-size N]
+#                                  [-f PATHS_FILE] [DISK_PATH|GLOB ...]
+# Prints one JSON line (NDJSON) per disk as soon as the disk is scanned
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import sys
+import glob
+import json
+import time
+import argparse
+import concurrent.futures
+
+from gpt_reader import DiskScan
+from gpt_cache import TableCache
+from gpt_metrics import Metrics
+from gpt_metrics import NULL_METRICS
+from gpt_report import header_dict
+from gpt_report import partition_dict
+from gpt_report import GptError
+from gpt_report import NotGptDiskError
+
+
+
+# header fields and checksums as dictionary for json output
+def header_record( header ):
+    return header_dict(header.report())
+
+
+
+def partition_record( partition ):
+    return partition_dict(partition.report())
+
+
+
+# scans one disk without printing anything
+# all errors are returned inside of record, so one broken disk
+# does not stop the whole scan
+# with cache (TableCache) unchanged disks are taken from it after reading LBA 1
+# with direct_io disks are read with O_DIRECT, bypassing page cache
+# with metrics record has phase timings and read counters of the disk
+# with probe every partition gets "filesystem" found by its signatures
+def scan_disk( disk_path, search_secret, cache=None, direct_io=False, metrics=False, probe=False ):
+    started=time.monotonic()
+    record={"path":disk_path, "gpt":False}
+    collector=Metrics() if metrics else NULL_METRICS
+    disk=DiskScan(disk_path, search_secret, direct_io=direct_io, metrics=collector)
+    try:
+        # opening first, so missing disks are reported as errors
+        disk.open()
+        cached=cache.lookup(disk.reader) if cache is not None else None
+        if cached is not None:
+            record=cached
+            record["cached"]=True
+        else:
+            disk.verify()
+            record["gpt"]=True
+            record["disk_sectors"]=disk.reader.DISK_SECTORS
+            record["lba_size"]=disk.reader.LBA_SIZE
+            disk.read_primary()
+            disk.read_secondary()
+            record["primary"]=header_record(disk.primary)
+            record["secondary"]=header_record(disk.secondary)
+            record["partitions"]=[partition_record(p) for p in disk.reader.PARTITIONS_LIST.values()]
+            # copy, fields added below (elapsed, metrics, filesystems) are not cached
+            if cache is not None:
+                cache.store(disk.reader, disk.primary, dict(record, partitions=list(record["partitions"])))
+        # filesystems can change without changes of GPT, so they are never cached
+        if probe and record.get("gpt"):
+            filesystems=disk.probe([(p["first_lba"], p["last_lba"]) for p in record["partitions"]])
+            record["partitions"]=[dict(p, filesystem=f) for p, f in zip(record["partitions"], filesystems)]
+    except NotGptDiskError:
+        pass
+    except (OSError, ValueError, GptError) as e:
+        record["error"]=str(e)
+    except Exception as e:
+        # bug or unexpected format of one disk, the others are still scanned
+        record["error"]=type(e).__name__+": "+str(e)
+    finally:
+        disk.close()
+    record["elapsed"]=round(time.monotonic()-started, 6)
+    if metrics:
+        record["metrics"]=collector.as_dict()
+    return record
+
+
+
+# expands globs and lists of paths into single list of disks
+# paths_file contains one path or glob per line
+def collect_paths( patterns, paths_file=None ):
+    if paths_file:
+        with open(paths_file) as file:
+            patterns=list(patterns)+[line.strip() for line in file
+                                      if line.strip() and not line.startswith("#")]
+    paths=[ ]
+    seen=set()
+    for pattern in patterns:
+        matches=sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+
+# scans disks in a bounded thread pool and yields records in order of completion
+# only jobs*2 disks are queued at a time, so huge lists do not pile up in memory
+def scan_disks( paths, search_secret=False, jobs=8, cache=None, direct_io=False, metrics=False, probe=False ):
+    jobs=max(1, jobs)
+    paths=iter(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        running=set()
+        while True:
+            for path in paths:
+                running.add(executor.submit(scan_disk, path, search_secret, cache, direct_io, metrics, probe))
+                if len(running)>=jobs*2:
+                    break
+            if not running:
+                return
+            done, running=concurrent.futures.wait(running,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Scan many GPT disks and print NDJSON records.")
+    parser.add_argument("paths", nargs="*", help="disk paths or globs (/dev/sd?, images/*.img)")
+    parser.add_argument("-f", "--paths-file", help="file with one disk path or glob per line")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="number of disks scanned at once")
+    parser.add_argument("-s", "--secret", action="store_true",
+                        help="search for partitions hidden by gpt_secret_partition")
+    parser.add_argument("-c", "--cache", action="store_true", help="reuse results of unchanged disks")
+    parser.add_argument("--cache-file", default=None,
+                        help="cache file for -c (default: ~/.cache/gptutils/tables.json)")
+    parser.add_argument("--cache-size", type=int, default=4096, help="number of disks kept in cache")
+    parser.add_argument("-d", "--direct", action="store_true",
+                        help="read with O_DIRECT so the scan does not pollute page cache")
+    parser.add_argument("-m", "--metrics", action="store_true",
+                        help="add phase timings and read counters to every record")
+    parser.add_argument("-p", "--probe", action="store_true",
+                        help="detect filesystems of partitions by their signatures; partitions in the "
+                             "middle of single-member compressed images are not probed")
+    options=parser.parse_args(args[1:])
+
+    paths=collect_paths(options.paths, options.paths_file)
+    if not paths:
+        parser.print_usage()
+        exit(-1)
+
+    cache=None
+    if options.cache:
+        try:
+            cache=TableCache(options.cache_file, options.cache_size)
+        except ValueError as e:
+            print(str(e))
+            exit(-1)
+    try:
+        for record in scan_disks(paths, options.secret, options.jobs, cache, options.direct, options.metrics,
+                                 options.probe):
+            sys.stdout.write(json.dumps(record)+"\n")
+            sys.stdout.flush()
+    finally:
+        if cache is not None:
+            cache.save()
+    return None
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,153 @@
+# Generator of synthetic GPT disk images (for Python 3)
+# USAGE: python3 gpt_image.py [-s SIZE_MIB] [-l LBA_SIZE] [-p PARTITIONS] [--hidden N] IMAGE_PATH
+# Images are sparse, only MBR, headers and partition tables are written
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import sys
+import zlib
+import uuid
+import struct
+import random
+import argparse
+
+from partition_type import PartitionType
+
+
+
+# header fields up to partition table checksum (92 bytes)
+HEADER_FORMAT="<8sIIIIQQQQ16sQIII"
+HEADER_SIZE=struct.calcsize(HEADER_FORMAT)
+
+
+
+def random_guid( rng ):
+    return uuid.UUID(int=rng.getrandbits(128), version=4).bytes_le
+
+
+
+# partition table with partitions spread over usable space
+# first hidden partitions have guids at the end of entry, as gpt_secret_partition does
+def build_partition_table( rng, entries_number, entry_size, partitions, hidden,
+                           first_usable, last_usable, type_guid ):
+    table=bytearray(entries_number*entry_size)
+    if partitions==0:
+        return table
+    span=(last_usable-first_usable+1)//partitions
+    for i in range(partitions):
+        first_lba=first_usable+i*span
+        last_lba=first_lba+span-1
+        name=("part"+str(i)).encode("utf-16-le")[0:72]
+        entry=bytearray(entry_size)
+        entry[0:16]=type_guid
+        entry[16:32]=random_guid(rng)
+        struct.pack_into("<QQQ", entry, 0x20, first_lba, last_lba, 0)
+        entry[0x38:0x38+len(name)]=name
+        if i<hidden:
+            entry[entry_size-32:entry_size]=entry[0:32]
+            entry[0:32]=bytes(32)
+        table[i*entry_size:(i+1)*entry_size]=entry
+    return table
+
+
+
+def build_header( lba_size, current_lba, backup_lba, first_usable, last_usable,
+                  disk_guid, entries_lba, entries_number, entry_size, entries_checksum ):
+    header=bytearray(struct.pack(HEADER_FORMAT, b"EFI PART", 0x00010000, HEADER_SIZE, 0, 0,
+                                 current_lba, backup_lba, first_usable, last_usable, disk_guid,
+                                 entries_lba, entries_number, entry_size, entries_checksum))
+    struct.pack_into("<I", header, 0x10, zlib.crc32(header))
+    return bytes(header)+bytes(lba_size-HEADER_SIZE)
+
+
+
+def build_protective_mbr( lba_size, disk_sectors ):
+    mbr=bytearray(lba_size)
+    # status, CHS start, type 0xEE, CHS end, first LBA, number of sectors
+    struct.pack_into("<BBBBBBBBII", mbr, 0x01BE, 0, 0, 2, 0, 0xEE, 0xFF, 0xFF, 0xFF,
+                     1, min(disk_sectors-1, 0xFFFFFFFF))
+    mbr[0x01FE:0x0200]=b"\x55\xaa"
+    return mbr
+
+
+
+# writes sparse GPT image and returns list of raw unique guids of partitions
+# corrupt_primary/corrupt_backup break header and partition table of that copy,
+# so both stored checksums of it are wrong
+def make_image( path, disk_size=64*1024*1024, lba_size=512, entries_number=128,
+                entry_size=128, partitions=4, hidden=0, corrupt_primary=False,
+                corrupt_backup=False, seed=None,
+                type_guid=PartitionType.Linux_filesystem_data.value ):
+    rng=random.Random(seed)
+    disk_sectors=disk_size//lba_size
+    table_lbas=-(-entries_number*entry_size//lba_size)
+    last_lba=disk_sectors-1
+    first_usable=2+table_lbas
+    last_usable=last_lba-1-table_lbas
+    if last_usable<first_usable+partitions:
+        raise ValueError("Disk of "+str(disk_size)+" bytes is too small for the partition table")
+
+    type_guid=uuid.UUID(type_guid).bytes_le
+    table=build_partition_table(rng, entries_number, entry_size, partitions, min(hidden, partitions),
+                                first_usable, last_usable, type_guid)
+    entries_checksum=zlib.crc32(table)
+    disk_guid=random_guid(rng)
+    primary_header=build_header(lba_size, 1, last_lba, first_usable, last_usable, disk_guid,
+                                2, entries_number, entry_size, entries_checksum)
+    backup_header=build_header(lba_size, last_lba, 1, first_usable, last_usable, disk_guid,
+                               last_lba-table_lbas, entries_number, entry_size, entries_checksum)
+
+    primary_table=bytearray(table)
+    backup_table=bytearray(table)
+    # name of first entry is changed, so set of detected partitions stays the same
+    if corrupt_primary:
+        primary_header=corrupt(primary_header)
+        primary_table[0x39]^=0xFF
+    if corrupt_backup:
+        backup_header=corrupt(backup_header)
+        backup_table[0x39]^=0xFF
+
+    with open(path,"wb") as image:
+        image.truncate(disk_sectors*lba_size)
+        image.write(build_protective_mbr(lba_size, disk_sectors))
+        image.write(primary_header)
+        image.write(primary_table)
+        image.seek((last_lba-table_lbas)*lba_size)
+        image.write(backup_table)
+        image.seek(last_lba*lba_size)
+        image.write(backup_header)
+    return [bytes(table[i*entry_size+16:i*entry_size+32]) for i in range(partitions)]
+
+
+
+# flips a byte of disk guid, so header checksum does not match any more
+def corrupt( header ):
+    header=bytearray(header)
+    header[0x38]^=0xFF
+    return bytes(header)
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Write sparse synthetic GPT image.")
+    parser.add_argument("path", help="image file to create")
+    parser.add_argument("-s", "--size", type=int, default=64, help="disk size in MiB")
+    parser.add_argument("-l", "--lba-size", type=int, default=512, help="logical sector size")
+    parser.add_argument("-n", "--entries", type=int, default=128, help="number of partition entries")
+    parser.add_argument("-e", "--entry-size", type=int, default=128, help="size of partition entry")
+    parser.add_argument("-p", "--partitions", type=int, default=4, help="number of partitions")
+    parser.add_argument("--hidden", type=int, default=0, help="number of hidden (secret) partitions")
+    parser.add_argument("--corrupt-primary", action="store_true", help="break primary header and table")
+    parser.add_argument("--corrupt-backup", action="store_true", help="break backup header and table")
+    parser.add_argument("--seed", type=int, default=None, help="seed for reproducible guids")
+    options=parser.parse_args(args[1:])
+
+    make_image(options.path, options.size*1024*1024, options.lba_size, options.entries,
+               options.entry_size, options.partitions, options.hidden,
+               options.corrupt_primary, options.corrupt_backup, options.seed)
+    return None
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
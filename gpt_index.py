@@ -0,0 +1,234 @@
+# SQLite index of partitions of many GPT disks (for Python 3)
+# USAGE: sudo python3 gpt_index.py [--db DB] ingest [-j JOBS] [-s] [-f PATHS_FILE] [DISK_PATH|GLOB ...]
+#        python3 gpt_index.py [--db DB] guid UNIQUE_GUID
+#        python3 gpt_index.py [--db DB] type TYPE_NAME|TYPE_GUID
+#        python3 gpt_index.py [--db DB] duplicates
+#        python3 gpt_index.py [--db DB] overlaps
+# Disks are scanned as gpt_fleet.py does and their partitions are inserted in
+# batches, one transaction per batch. Queries print one JSON line per row
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+from gpt_fleet import scan_disks
+from gpt_fleet import collect_paths
+from gpt_cache import default_cache_path
+from gpt_cache import disk_identity
+from gpt_structures import unique_guid_key
+from partition_type import TYPES_BY_STRING
+
+
+
+SCHEMA="""
+CREATE TABLE IF NOT EXISTS disks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    identity TEXT,
+    gpt INTEGER NOT NULL,
+    disk_sectors INTEGER,
+    lba_size INTEGER,
+    error TEXT,
+    scanned REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS partitions (
+    disk_id INTEGER NOT NULL REFERENCES disks(id),
+    unique_guid TEXT NOT NULL,
+    type_guid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    name TEXT,
+    first_lba INTEGER NOT NULL,
+    last_lba INTEGER NOT NULL,
+    attributes INTEGER NOT NULL,
+    is_secret INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS partitions_unique_guid ON partitions(unique_guid);
+CREATE INDEX IF NOT EXISTS partitions_type_guid ON partitions(type_guid);
+CREATE INDEX IF NOT EXISTS partitions_disk ON partitions(disk_id, first_lba);
+"""
+
+PARTITION_COLUMNS=("unique_guid", "type_guid", "type", "name", "first_lba", "last_lba",
+                   "attributes", "is_secret")
+
+# disks written in one transaction
+BATCH_SIZE=1000
+
+
+
+def default_database_path( ):
+    return os.path.join(os.path.dirname(default_cache_path()), "partitions.sqlite")
+
+
+
+# opens database and creates tables if they are missing
+# WAL journal lets queries run while ingest is writing
+def connect( database_path=None ):
+    database_path=database_path or default_database_path()
+    directory=os.path.dirname(database_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection=sqlite3.connect(database_path)
+    connection.row_factory=sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+
+# identity of the disk as in gpt_cache, None for disks which can not be opened
+def record_identity( record ):
+    try:
+        size=record.get("disk_sectors", 0)*record.get("lba_size", 0)
+        return disk_identity(record["path"], size, False)
+    except OSError:
+        return None
+
+
+
+# writes one batch of fleet records in one transaction
+# old rows of the same disks are replaced
+def insert_batch( connection, records ):
+    scanned=time.time()
+    partitions=[ ]
+    with connection:
+        connection.executemany("DELETE FROM partitions WHERE disk_id IN (SELECT id FROM disks WHERE path=?)",
+                               [(record["path"],) for record in records])
+        connection.executemany("DELETE FROM disks WHERE path=?", [(record["path"],) for record in records])
+        for record in records:
+            cursor=connection.execute(
+                "INSERT INTO disks (path, identity, gpt, disk_sectors, lba_size, error, scanned) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (record["path"], record_identity(record), int(record.get("gpt", False)),
+                 record.get("disk_sectors"), record.get("lba_size"), record.get("error"), scanned))
+            disk_id=cursor.lastrowid
+            for partition in record.get("partitions", [ ]):
+                partitions.append((disk_id, partition["unique_guid"], partition["guid"], partition["type"],
+                                   partition["name"], partition["first_lba"], partition["last_lba"],
+                                   partition["attributes"], int(partition["is_secret"])))
+        connection.executemany("INSERT INTO partitions (disk_id, "+", ".join(PARTITION_COLUMNS)+") "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", partitions)
+    return len(partitions)
+
+
+
+# inserts records (gpt_fleet.scan_disks) in batches of batch_size disks
+# returns (number of disks, number of partitions)
+def ingest( connection, records, batch_size=BATCH_SIZE ):
+    disks=0
+    partitions=0
+    batch=[ ]
+    for record in records:
+        batch.append(record)
+        if len(batch)>=batch_size:
+            partitions+=insert_batch(connection, batch)
+            disks+=len(batch)
+            batch=[ ]
+    if batch:
+        partitions+=insert_batch(connection, batch)
+        disks+=len(batch)
+    return disks, partitions
+
+
+
+PARTITION_SELECT=("SELECT disks.path, "+", ".join("partitions."+c for c in PARTITION_COLUMNS)+
+                  " FROM partitions JOIN disks ON disks.id=partitions.disk_id ")
+
+
+
+# partitions with unique guid (hex of raw bytes or standard string)
+def find_guid( connection, guid ):
+    return connection.execute(PARTITION_SELECT+"WHERE partitions.unique_guid=? ORDER BY disks.path",
+                              (unique_guid_key(guid),)).fetchall()
+
+
+
+# partitions of type given by PartitionType name or type guid
+def find_type( connection, type_name ):
+    guids=[guid for guid, name in TYPES_BY_STRING.items() if name==type_name]
+    if not guids:
+        guids=[type_name.strip("{}").upper()]
+    return connection.execute(PARTITION_SELECT+"WHERE partitions.type_guid IN ("+
+                              ", ".join("?"*len(guids))+") ORDER BY disks.path, partitions.first_lba",
+                              guids).fetchall()
+
+
+
+# unique guids used by more than one partition (cloned disks)
+def find_duplicates( connection ):
+    return connection.execute(PARTITION_SELECT+"WHERE partitions.unique_guid IN ("
+                              "SELECT unique_guid FROM partitions GROUP BY unique_guid HAVING COUNT(*)>1) "
+                              "ORDER BY partitions.unique_guid, disks.path").fetchall()
+
+
+
+# pairs of partitions of the same disk with crossing LBA ranges
+def find_overlaps( connection ):
+    return connection.execute(
+        "SELECT disks.path, a.unique_guid AS first_guid, a.first_lba AS first_start, a.last_lba AS first_end, "
+        "b.unique_guid AS second_guid, b.first_lba AS second_start, b.last_lba AS second_end "
+        "FROM partitions a JOIN partitions b ON a.disk_id=b.disk_id AND a.rowid<b.rowid "
+        "AND a.first_lba<=b.last_lba AND b.first_lba<=a.last_lba "
+        "JOIN disks ON disks.id=a.disk_id ORDER BY disks.path, a.first_lba").fetchall()
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Index partitions of many GPT disks in SQLite.")
+    parser.add_argument("--db", default=None,
+                        help="database file (default: ~/.cache/gptutils/partitions.sqlite)")
+    commands=parser.add_subparsers(dest="command")
+    ingest_parser=commands.add_parser("ingest", help="scan disks and store their partitions")
+    ingest_parser.add_argument("paths", nargs="*", help="disk paths or globs (/dev/sd?, images/*.img)")
+    ingest_parser.add_argument("-f", "--paths-file", help="file with one disk path or glob per line")
+    ingest_parser.add_argument("-j", "--jobs", type=int, default=8, help="number of disks scanned at once")
+    ingest_parser.add_argument("-s", "--secret", action="store_true",
+                               help="search for partitions hidden by gpt_secret_partition")
+    ingest_parser.add_argument("-b", "--batch", type=int, default=BATCH_SIZE, help="disks per transaction")
+    guid_parser=commands.add_parser("guid", help="partitions with unique guid")
+    guid_parser.add_argument("guid")
+    type_parser=commands.add_parser("type", help="partitions of type (PartitionType name or guid)")
+    type_parser.add_argument("type")
+    commands.add_parser("duplicates", help="unique guids used by more than one partition")
+    commands.add_parser("overlaps", help="partitions with crossing LBA ranges on the same disk")
+    options=parser.parse_args(args[1:])
+
+    if options.command is None:
+        parser.print_usage()
+        exit(-1)
+    connection=connect(options.db)
+    try:
+        if options.command=="ingest":
+            paths=collect_paths(options.paths, options.paths_file)
+            if not paths:
+                ingest_parser.print_usage()
+                exit(-1)
+            started=time.monotonic()
+            disks, partitions = ingest(connection, scan_disks(paths, options.secret, options.jobs),
+                                       options.batch)
+            print("Indexed disks: "+str(disks)+", partitions: "+str(partitions)+
+                  " in "+str(round(time.monotonic()-started, 3))+" s")
+            return None
+        if options.command=="guid":
+            rows=find_guid(connection, options.guid)
+        elif options.command=="type":
+            rows=find_type(connection, options.type)
+        elif options.command=="duplicates":
+            rows=find_duplicates(connection)
+        else:
+            rows=find_overlaps(connection)
+        for row in rows:
+            sys.stdout.write(json.dumps(dict(row))+"\n")
+    finally:
+        connection.close()
+    return None
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
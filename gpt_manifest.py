@@ -0,0 +1,306 @@
+# Hash manifests of GPT partitions for tamper checks (for Python 3)
+# USAGE: sudo python3 gpt_manifest.py [-s] [-j JOBS] [-b BLOCK_MIB] [-m MANIFEST] [-u] [--full] DISK_PATH
+# Every partition (with -s also hidden ones) is split into blocks, blocks are
+# hashed in parallel and joined into Merkle tree. Without manifest it is created,
+# otherwise disk is compared with it (and with -u manifest is updated).
+# Next runs hash again only blocks which can be changed: all data blocks
+# if mtime of the image changed, and blocks whose data/hole map changed.
+# Block devices do not change mtime, so their blocks are always hashed
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import sys
+import json
+import stat
+import errno
+import bisect
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+
+from gpt_reader import DiskScan
+from gpt_report import GptError
+from gpt_cache import disk_cache_path
+
+
+
+MANIFEST_VERSION=1
+ALGORITHM="sha256"
+BLOCK_SIZE=4*1024*1024
+
+
+
+def default_manifest_path( disk_path ):
+    return disk_cache_path("manifest", disk_path, ".json")
+
+
+
+# Merkle root of list of digests: pairs are hashed level by level,
+# the last odd digest goes to the next level as it is
+def merkle_root( digests, algorithm=ALGORITHM ):
+    if not digests:
+        return hashlib.new(algorithm).hexdigest()
+    level=[bytes.fromhex(digest) for digest in digests]
+    while len(level)>1:
+        next_level=[hashlib.new(algorithm, level[i]+level[i+1]).digest()
+                    for i in range(0, len(level)-1, 2)]
+        if len(level)%2:
+            next_level.append(level[-1])
+        level=next_level
+    return level[0].hex()
+
+
+
+# [(start, end)] of data in range of the file, holes are skipped
+# devices and file systems without SEEK_DATA are one data extent
+def data_extents( fd, start, end ):
+    extents=[ ]
+    position=start
+    while position<end:
+        try:
+            data=os.lseek(fd, position, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno==errno.ENXIO:
+                break
+            if e.errno==errno.EINVAL:
+                return [(position, end)]
+            raise
+        if data>=end:
+            break
+        hole=min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        extents.append((data, hole))
+        position=hole
+    return extents
+
+
+
+# data extents inside of one block, relative to block start
+def block_extents( extents, starts, block_start, block_end ):
+    result=[ ]
+    i=max(0, bisect.bisect_right(starts, block_start)-1)
+    while i<len(extents) and extents[i][0]<block_end:
+        start=max(extents[i][0], block_start)
+        end=min(extents[i][1], block_end)
+        if start<end:
+            result.append([start-block_start, end-block_start])
+        i+=1
+    return result
+
+
+
+# hashes blocks of one opened disk in threads, every thread reads
+# into its own buffer, so there is no new bytes object per block
+class BlockHasher( object ):
+
+    def __init__( self, fd, block_size, algorithm=ALGORITHM ):
+        self.fd=fd
+        self.block_size=block_size
+        self.algorithm=algorithm
+        self.local=threading.local()
+        # {length:digest} of blocks without data
+        self.zero_digests=dict()
+
+    def zero_digest( self, length ):
+        digest=self.zero_digests.get(length)
+        if digest is None:
+            digest=self.zero_digests[length]=hashlib.new(self.algorithm, bytes(length)).hexdigest()
+        return digest
+
+    # digest of block at offset, holes are not read
+    def hash_block( self, offset, length, extents ):
+        if not extents:
+            return self.zero_digest(length)
+        buffer=getattr(self.local, "buffer", None)
+        if buffer is None:
+            buffer=self.local.buffer=memoryview(bytearray(self.block_size))
+        view=buffer[0:length]
+        done=0
+        while done<length:
+            count=os.preadv(self.fd, [view[done:]], offset+done)
+            if count==0:
+                # disk is shorter than partition says, the rest is hashed as zeros
+                view[done:]=bytes(length-done)
+                break
+            done+=count
+        return hashlib.new(self.algorithm, view).hexdigest()
+
+
+
+# partitions of the disk as {unique guid:{"first_lba", "last_lba", "is_secret"}}
+def disk_partitions( disk_path, search_secret ):
+    with DiskScan(disk_path, search_secret) as disk:
+        reader=disk.open().verify().reader
+        if not reader.source.writable:
+            raise ValueError("Manifests are made only of raw disks and images, not of "+disk_path)
+        disk.read_primary()
+        disk.read_secondary()
+        partitions={partition.unique_guid:{"first_lba":partition.first_lba,
+                                           "last_lba":partition.last_lba,
+                                           "is_secret":partition.is_secret}
+                    for partition in reader.PARTITIONS_LIST.values()}
+        return partitions, reader.LBA_SIZE
+
+
+
+# identity which tells if image could be changed since last manifest
+def file_identity( st ):
+    return {"dev":st.st_dev, "ino":st.st_ino, "size":st.st_size, "mtime_ns":st.st_mtime_ns,
+            "block_device":stat.S_ISBLK(st.st_mode)}
+
+
+
+# makes manifest of the disk, blocks which can not be changed since
+# previous manifest are taken from it instead of hashing
+# returns (manifest, number of read and hashed blocks)
+def build_manifest( disk_path, search_secret=False, jobs=None, block_size=BLOCK_SIZE,
+                    previous=None, full=False ):
+    partitions, lba_size = disk_partitions(disk_path, search_secret)
+    fd=os.open(disk_path, os.O_RDONLY)
+    try:
+        identity=file_identity(os.fstat(fd))
+        # all data blocks must be hashed again if image could be written
+        if (full or previous is None or identity["block_device"]
+                or previous.get("identity")!=identity or previous.get("block_size")!=block_size
+                or previous.get("lba_size")!=lba_size or previous.get("algorithm")!=ALGORITHM):
+            unchanged=None
+        else:
+            unchanged=previous["partitions"]
+
+        hasher=BlockHasher(fd, block_size)
+        # [(guid, block index, offset, length, extents)] to hash
+        tasks=[ ]
+        manifest_partitions=dict()
+        for guid, partition in partitions.items():
+            start=partition["first_lba"]*lba_size
+            end=(partition["last_lba"]+1)*lba_size
+            extents=data_extents(fd, start, end)
+            starts=[extent[0] for extent in extents]
+            old=unchanged.get(guid) if unchanged is not None else None
+            if old is not None and (old["first_lba"], old["last_lba"])!=(partition["first_lba"], partition["last_lba"]):
+                old=None
+            blocks=[ ]
+            block_map=[ ]
+            for index, block_start in enumerate(range(start, max(start, end), block_size)):
+                block_end=min(block_start+block_size, end)
+                block_data=block_extents(extents, starts, block_start, block_end)
+                block_map.append(block_data)
+                if old is not None and old["extents"][index]==block_data:
+                    blocks.append(old["blocks"][index])
+                else:
+                    blocks.append(None)
+                    tasks.append((guid, index, block_start, block_end-block_start, block_data))
+            manifest_partitions[guid]=dict(partition, blocks=blocks, extents=block_map)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            digests=executor.map(lambda task: hasher.hash_block(task[2], task[3], task[4]), tasks)
+            for task, digest in zip(tasks, digests):
+                manifest_partitions[task[0]]["blocks"][task[1]]=digest
+    finally:
+        os.close(fd)
+
+    for partition in manifest_partitions.values():
+        partition["root"]=merkle_root(partition["blocks"])
+    manifest={
+        "version":MANIFEST_VERSION,
+        "disk":disk_path,
+        "identity":identity,
+        "algorithm":ALGORITHM,
+        "lba_size":lba_size,
+        "block_size":block_size,
+        "partitions":manifest_partitions,
+        "root":merkle_root([manifest_partitions[guid]["root"] for guid in sorted(manifest_partitions)])
+    }
+    # blocks without data are not read
+    return manifest, sum(1 for task in tasks if task[4])
+
+
+
+# differences of new manifest from stored one:
+# {"added", "removed", "changed":{guid:[block indexes]}}
+# equal roots of partitions mean no block comparison is needed
+def compare_manifests( stored, current ):
+    stored_partitions=stored["partitions"]
+    current_partitions=current["partitions"]
+    changed=dict()
+    for guid in sorted(set(stored_partitions) & set(current_partitions)):
+        old=stored_partitions[guid]
+        new=current_partitions[guid]
+        if old["root"]==new["root"]:
+            continue
+        changed[guid]=[i for i in range(max(len(old["blocks"]), len(new["blocks"])))
+                       if old["blocks"][i:i+1]!=new["blocks"][i:i+1]]
+    return {"added":sorted(set(current_partitions)-set(stored_partitions)),
+            "removed":sorted(set(stored_partitions)-set(current_partitions)),
+            "changed":changed}
+
+
+
+def load_manifest( manifest_path ):
+    try:
+        with open(manifest_path) as file:
+            manifest=json.load(file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version")!=MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+
+def save_manifest( manifest_path, manifest ):
+    directory=os.path.dirname(os.path.abspath(manifest_path))
+    os.makedirs(directory, exist_ok=True)
+    temporary=manifest_path+"."+str(os.getpid())+".tmp"
+    with open(temporary,"w") as file:
+        json.dump(manifest, file)
+    os.replace(temporary, manifest_path)
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Make or check hash manifest of GPT partitions.")
+    parser.add_argument("path", help="disk path or raw image")
+    parser.add_argument("-s", "--secret", action="store_true",
+                        help="hash partitions hidden by gpt_secret_partition too")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="hashing threads (default: CPU count)")
+    parser.add_argument("-b", "--block", type=int, default=BLOCK_SIZE//(1024*1024), help="block size in MiB")
+    parser.add_argument("-m", "--manifest", default=None,
+                        help="manifest file (default: ~/.cache/gptutils/manifest/DISK.json)")
+    parser.add_argument("-u", "--update", action="store_true", help="save new manifest after check")
+    parser.add_argument("--full", action="store_true", help="hash all blocks, do not trust mtime")
+    options=parser.parse_args(args[1:])
+
+    manifest_path=options.manifest or default_manifest_path(options.path)
+    stored=load_manifest(manifest_path)
+    try:
+        manifest, hashed = build_manifest(options.path, options.secret, options.jobs,
+                                          options.block*1024*1024, stored, options.full)
+    except (OSError, ValueError, GptError) as e:
+        print(str(e))
+        exit(-1)
+    print("Hashed blocks: "+str(hashed)+", root: "+manifest["root"])
+
+    if stored is None:
+        save_manifest(manifest_path, manifest)
+        print("Manifest saved to "+manifest_path)
+        exit(0)
+    difference=compare_manifests(stored, manifest)
+    for guid in difference["added"]:
+        print("New partition: "+guid)
+    for guid in difference["removed"]:
+        print("Removed partition: "+guid)
+    for guid, blocks in difference["changed"].items():
+        print("Changed partition: "+guid+" blocks: "+", ".join(str(i) for i in blocks))
+    tampered=difference["added"] or difference["removed"] or difference["changed"]
+    if not tampered:
+        print("Disk matches manifest "+manifest_path)
+    if options.update:
+        save_manifest(manifest_path, manifest)
+    exit(1 if tampered else 0)
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,127 @@
+# Metrics of GPT utilities: phase timers and I/O counters (for Python 3)
+# USAGE: see gpt_fleet.py --metrics
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import time
+
+
+
+# names of phases and counters used by GptReader, GptHeader, hide_partition and gpt_repair
+PHASES=("verify", "primary_read", "secondary_read", "entry_decode", "checksum", "compare", "probe", "write")
+COUNTERS=("bytes_read", "reads", "seeks", "bytes_written", "writes")
+
+
+
+# timer of one phase, adds its wall time to collector on exit
+class PhaseTimer( object ):
+    __slots__=("metrics", "name", "started")
+
+    def __init__( self, metrics, name ):
+        self.metrics=metrics
+        self.name=name
+        self.started=None
+
+    def __enter__( self ):
+        self.started=time.perf_counter()
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.metrics.add_time(self.name, time.perf_counter()-self.started)
+        return False
+
+
+
+# collector of metrics of one disk (or one run)
+# seeks are reads and writes which do not continue the previous one,
+# positioned pread/pwrite calls do not need separate seek calls
+class Metrics( object ):
+    enabled=True
+
+    def __init__( self ):
+        # {phase:[calls, seconds]}
+        self.timings=dict()
+        self.counters=dict.fromkeys(COUNTERS, 0)
+        # end of the last read or write, to count seeks
+        self.position=None
+
+    def phase( self, name ):
+        return PhaseTimer(self, name)
+
+    def add_time( self, name, seconds ):
+        timing=self.timings.get(name)
+        if timing is None:
+            timing=self.timings[name]=[0, 0.0]
+        timing[0]+=1
+        timing[1]+=seconds
+
+    def count( self, name, value=1 ):
+        self.counters[name]=self.counters.get(name, 0)+value
+
+    def io( self, kind, offset, length ):
+        if offset!=self.position:
+            self.counters["seeks"]+=1
+        self.position=offset+length
+        if kind=="read":
+            self.counters["reads"]+=1
+            self.counters["bytes_read"]+=length
+        else:
+            self.counters["writes"]+=1
+            self.counters["bytes_written"]+=length
+
+    # adds metrics of other collector, for totals of many disks
+    def merge( self, other ):
+        for name, (calls, seconds) in other.timings.items():
+            timing=self.timings.setdefault(name, [0, 0.0])
+            timing[0]+=calls
+            timing[1]+=seconds
+        for name, value in other.counters.items():
+            self.counters[name]=self.counters.get(name, 0)+value
+
+    def as_dict( self ):
+        result={"phases":{name:{"calls":calls, "seconds":round(seconds, 9)}
+                          for name, (calls, seconds) in self.timings.items()}}
+        result.update(self.counters)
+        return result
+
+
+
+# timer which does nothing
+class NullTimer( object ):
+    __slots__=()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        return False
+
+NULL_TIMER=NullTimer()
+
+
+
+# collector used when metrics are turned off,
+# every call returns at once and nothing is stored
+class NullMetrics( object ):
+    enabled=False
+
+    def phase( self, name ):
+        return NULL_TIMER
+
+    def add_time( self, name, seconds ):
+        pass
+
+    def count( self, name, value=1 ):
+        pass
+
+    def io( self, kind, offset, length ):
+        pass
+
+    def merge( self, other ):
+        pass
+
+    def as_dict( self ):
+        return { }
+
+NULL_METRICS=NullMetrics()
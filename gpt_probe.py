@@ -0,0 +1,129 @@
+# Probing filesystems of GPT partitions by their signatures (for Python 3)
+# USAGE: see gpt_fleet.py --probe
+# Signature offsets of all partitions are sorted and merged into a few
+# reads, so every partition costs about one read, not one read per check
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import struct
+
+
+
+# (filesystem, offset from partition start, magic) in order of checking:
+# containers first, because they can hold anything at other offsets
+SIGNATURES=(
+    ("crypto_LUKS", 0, b"LUKS\xba\xbe"),
+    ("LVM2_member", 0x218, b"LVM2 001"),
+    ("linux_raid_member", 0x1000, b"\xfc\x4e\x2b\xa9"),
+    ("linux_raid_member", 0, b"\xfc\x4e\x2b\xa9"),
+    ("swap", 0x1000-10, b"SWAPSPACE2"),
+    ("swap", 0x1000-10, b"SWAP-SPACE"),
+    ("btrfs", 0x10040, b"_BHRfS_M"),
+    ("xfs", 0, b"XFSB"),
+    ("ext4", 0x438, b"\x53\xef"),
+    ("ntfs", 3, b"NTFS    "),
+    ("exfat", 3, b"EXFAT   "),
+    ("vfat", 0x52, b"FAT32   "),
+    ("vfat", 0x36, b"FAT16   "),
+    ("vfat", 0x36, b"FAT12   "),
+    ("iso9660", 0x8001, b"CD001")
+)
+
+# ext2/3/4 superblock, features tell them apart
+EXT_SUPERBLOCK=(0x400, 0x100)
+EXT_COMPAT_HAS_JOURNAL=0x4
+EXT_INCOMPAT_EXT4=0x40|0x80|0x200
+
+# regions closer than this are read at once, 64 KiB covers all signatures
+# of one partition, so a partition is one read
+MERGE_GAP=64*1024
+# merged read is never bigger than this
+MAX_READ=1024*1024
+
+
+
+# (offset, length) regions of one partition needed by signatures,
+# only regions inside of partition
+def partition_regions( start, length ):
+    regions=[(start+offset, len(magic)) for name, offset, magic in SIGNATURES
+             if offset+len(magic)<=length]
+    if EXT_SUPERBLOCK[0]+EXT_SUPERBLOCK[1]<=length:
+        regions.append((start+EXT_SUPERBLOCK[0], EXT_SUPERBLOCK[1]))
+    return regions
+
+
+
+# sorted regions merged into [(offset, length)] reads
+def merge_regions( regions, gap=MERGE_GAP, max_read=MAX_READ ):
+    reads=[ ]
+    for offset, length in sorted(regions):
+        if reads:
+            read_offset, read_length = reads[-1]
+            end=max(read_offset+read_length, offset+length)
+            if offset<=read_offset+read_length+gap and end-read_offset<=max_read:
+                reads[-1]=(read_offset, end-read_offset)
+                continue
+        reads.append((offset, length))
+    return reads
+
+
+
+# filesystem of ext superblock by its features
+def ext_version( superblock ):
+    compat, incompat = struct.unpack_from("<II", superblock, 0x5C)
+    if incompat & EXT_INCOMPAT_EXT4:
+        return "ext4"
+    if compat & EXT_COMPAT_HAS_JOURNAL:
+        return "ext3"
+    return "ext2"
+
+
+
+# reads merged regions, returns function giving bytes at (offset, length)
+def read_regions( source, regions ):
+    reads=merge_regions(regions)
+    data=[(offset, source.read(offset, length)) for offset, length in reads]
+    starts=[offset for offset, length in reads]
+
+    def bytes_at( offset, length ):
+        # reads are few, so linear search is fine
+        for i in range(len(starts)-1, -1, -1):
+            if starts[i]<=offset:
+                read_offset, view = data[i]
+                return view[offset-read_offset:offset-read_offset+length]
+        return b''
+    return bytes_at
+
+
+
+# filesystem names (or None) of partitions given as (first_lba, last_lba)
+# source is DiskSource (or other source of gpt_reader), all signatures
+# of all partitions are read in merged reads. Partitions which can not be read
+# cheaply (middle of single-member compressed image) are not probed, they are None
+def probe_ranges( source, lba_size, ranges ):
+    partitions=[(first_lba*lba_size, (last_lba-first_lba+1)*lba_size)
+                for first_lba, last_lba in ranges if last_lba>=first_lba]
+    regions=[ ]
+    for start, length in partitions:
+        partition=partition_regions(start, length)
+        if all(source.cheap_read(offset, size) for offset, size in partition):
+            regions+=partition
+    bytes_at=read_regions(source, regions)
+
+    result=[ ]
+    for first_lba, last_lba in ranges:
+        start=first_lba*lba_size
+        length=(last_lba-first_lba+1)*lba_size
+        filesystem=None
+        for name, offset, magic in SIGNATURES:
+            if offset+len(magic)<=length and bytes_at(start+offset, len(magic))==magic:
+                filesystem=name
+                break
+        if filesystem=="ext4":
+            superblock=bytes_at(start+EXT_SUPERBLOCK[0], EXT_SUPERBLOCK[1])
+            if len(superblock)==EXT_SUPERBLOCK[1]:
+                filesystem=ext_version(superblock)
+        result.append(filesystem)
+    return result
+
@@ -5,237 +5,385 @@
 # Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
 
 import sys
+import json
+import argparse
 
 from gpt_structures import GptHeader
 from gpt_structures import GptPartition
+from gpt_structures import decode_partition_entries
+from disk_source import open_disk_source
+from gpt_probe import probe_ranges
+from gpt_metrics import NULL_METRICS
+from gpt_report import GptError
+from gpt_report import NotGptDiskError
+from gpt_report import MbrReport
+from gpt_report import DiskReport
+from gpt_report import report_dict
+from gpt_report import format_report
+from gpt_report import format_quiet
 
 
 
 # class for parsing data from gpt disks
 class GptReader( object ):
     DISK_PATH=None
+    # logical sector size, detected when disk is opened
+    # (block device sector size or place of primary header)
     LBA_SIZE=512
+    LBA_SIZE_FIXED=False
+    # sector sizes where primary header is searched on images
+    KNOWN_LBA_SIZES=(512, 4096, 1024, 2048)
     # 128 bytes must be correct for most of the disks
-    # Or it can be replaced with header.entry_size
+    # header.entry_size is used when header has sane value
     GPT_ENTRY_SIZE=128
-    # size of the disk
+    # default size of partition table - 128 entries of 128 bytes
+    GPT_TABLE_SIZE=128*128
+    # bigger tables are treated as broken headers
+    MAX_TABLE_SIZE=16*1024*1024
+    # size of the disk, set by verify_gpt()
     DISK_SECTORS=0
-    # dictionary with detected partitions:
-    # {partition unique guid:partition object}
-    PARTITIONS_LIST=dict()
+    # dictionary with detected partitions of this reader:
+    # {raw partition unique guid:partition object}
+    PARTITIONS_LIST=None
 
     # secret search will also search the end of partitions
     # for guids such as gpt_secret_partitions does for
     # hiding partitions
     SEARCH_SECRET=False
 
-    def __init__( self, disk_path, search_secret ):
+    # DiskSource (or compressed, container or sparse source) with the only opened handle of the disk
+    # all reads of MBR, headers and tables go through it
+    source=None
+    USE_MMAP=False
+    # O_DIRECT reads, so scans do not fill page cache
+    DIRECT_IO=False
+
+    # verify_gpt prints its steps only in verbose mode
+    VERBOSE=True
+    # why verify_gpt failed, and MBR records if it succeeded
+    error=None
+    mbr=None
+    # collector of phase timings and read counters (gpt_metrics)
+    metrics=NULL_METRICS
+
+    # lba_size=None means autodetection
+    def __init__( self, disk_path, search_secret, use_mmap=False, verbose=True,
+                  lba_size=None, direct_io=False, metrics=NULL_METRICS ):
+        self.metrics=metrics
         self.SEARCH_SECRET=search_secret
         self.DISK_PATH=disk_path
+        self.USE_MMAP=use_mmap
+        self.VERBOSE=verbose
+        self.DIRECT_IO=direct_io
+        if lba_size is not None:
+            self.LBA_SIZE=lba_size
+            self.LBA_SIZE_FIXED=True
+        # every reader has its own partitions and disk size,
+        # so readers can work in different threads
+        self.DISK_SECTORS=0
+        self.PARTITIONS_LIST=dict()
+
+    def log( self, message ):
+        if self.VERBOSE:
+            print(message)
+
+    # logs why the disk is not GPT, keeps it for scan() and returns False
+    def fail( self, message ):
+        self.log(message)
+        self.error=message
+        return False
+
+    # opens the disk once, next calls return the same source
+    def open_source( self ):
+        if self.source is None:
+            self.source=open_disk_source(self.DISK_PATH, self.USE_MMAP, self.DIRECT_IO, self.metrics)
+            if not self.LBA_SIZE_FIXED:
+                self.LBA_SIZE=self.detect_lba_size()
+        return self.source
+
+    # block devices report their logical sector size,
+    # for images sector size is where "EFI PART" of primary header is
+    def detect_lba_size( self ):
+        lba_size=self.source.logical_block_size()
+        if lba_size:
+            return lba_size
+        for lba_size in self.KNOWN_LBA_SIZES:
+            if self.source.read(lba_size, 8)==b"EFI PART":
+                return lba_size
+        return self.LBA_SIZE
+
+    def close( self ):
+        if self.source is not None:
+            self.source.close()
+            self.source=None
 
     # verifying gpt through signatures and Protective MBR test
     def verify_gpt( self ):
-        global DISK_SECTORS
+        with self.metrics.phase("verify"):
+            return self.check_protective_mbr()
+
+    def check_protective_mbr( self ):
         try:
-            file = open(self.DISK_PATH,"rb")
-            protective_mbr = file.read(self.LBA_SIZE)
-            file.close()
+            protective_mbr = self.open_source().read(0, self.LBA_SIZE)
         except FileNotFoundError:
-            print("There is no "+self.DISK_PATH+" disk.")
-            return False
+            return self.fail("There is no "+self.DISK_PATH+" disk.")
 
         MBR_signature = protective_mbr[0x01FE:0x01FE+2]
         if MBR_signature.hex() == "55aa":
-            print("MBR signature found.")
+            self.log("MBR signature found.")
         else:
-            print("MBR signature not found.")
-            return False
+            return self.fail("MBR signature not found.")
 
         # reading Protective MBR
         partition_table = [ ]
-        print("\nMBR Partition table: ")
+        self.log("\nMBR Partition table: ")
         for i in range(0,4):
             partition_table.append(protective_mbr[0x01BE+16*i:0x01BE+16*i+16])
-            print(partition_table[i].hex())
+            self.log(partition_table[i].hex())
         # first partition must not be empty
         if partition_table[0].hex()=="0"*32:
-            print("There is no first partition.")
-            return False
+            return self.fail("There is no first partition.")
         # all the other partititons must be empty
         for i in range(1,4):
             if not partition_table[i].hex()=="0"*32:
-                print("There is some MBR partition except first one. This is not a GPT disk.")
-                return False
+                return self.fail("There is some MBR partition except first one. This is not a GPT disk.")
         
         # the only record of protective mbr must ends at the end of disk
         guid_first_partition=partition_table[0]
         guid_first_partition_sectors=int.from_bytes(guid_first_partition[0x0C:0x0C+4],"little")+1
-        print("\nDisk size in sectors (if not - you are not running a GPT disk): "+str(guid_first_partition_sectors))
+        self.log("\nDisk size in sectors (if not - you are not running a GPT disk): "+str(guid_first_partition_sectors))
 
         # the only record of protective mbr must have 0xEE signature
         gpt_signature=guid_first_partition[0x04:0x04+1]
-        print("Signature of first MBR partition: "+gpt_signature.hex())
+        self.log("Signature of first MBR partition: "+gpt_signature.hex())
         if not gpt_signature.hex() == "ee":
-            print("Signature is not 0xEE. This is not a GPT disk.")
-            return False
+            return self.fail("Signature is not 0xEE. This is not a GPT disk.")
         
         # verifying complete
-        print("GPT disk found on "+self.DISK_PATH+".\n")
-        DISK_SECTORS=guid_first_partition_sectors
+        self.log("GPT disk found on "+self.DISK_PATH+".\n")
+        self.mbr=MbrReport(tuple(bytes(record) for record in partition_table), guid_first_partition_sectors)
+        self.DISK_SECTORS=guid_first_partition_sectors
+        # MBR can not store more than 2^32 sectors, real size is better
+        if self.source.size>0:
+            self.DISK_SECTORS=self.source.size//self.LBA_SIZE
         return True
 
 
 
     # there is two gpt tables on disk - at the beginning and end
     def read_primary_gpt_header( self ):
-        file = open(self.DISK_PATH,"rb")
-        # jump to LBA 1
-        gpt_header_offset=self.LBA_SIZE
-        file.seek(gpt_header_offset) 
-        gpt_header = file.read(self.LBA_SIZE)
-        # read LBA 2-33
-        gpt_partition_table_offset=self.LBA_SIZE*2
-        gpt_partition_table = file.read(self.LBA_SIZE*32)
-        file.close()
-
-        header=GptHeader(gpt_header, gpt_header_offset, 
-                        gpt_partition_table, gpt_partition_table_offset)
-        return header
+        # LBA 1, table is at LBA 2-33 if header does not say otherwise
+        with self.metrics.phase("primary_read"):
+            return self.read_gpt_header(self.LBA_SIZE, self.LBA_SIZE*2)
 
 
 
     def read_secondary_gpt_header( self ):
-        file = open(self.DISK_PATH,"rb")
-        # jump to LBA -1
-        secondary_gpt_header_offset=DISK_SECTORS*512-self.LBA_SIZE
-        file.seek(secondary_gpt_header_offset)
-        secondary_gpt_header = file.read(self.LBA_SIZE)
-        # jump to LBA -33, read LBA -33-(-2)
-        secondary_gpt_partition_table_offset=DISK_SECTORS*512-self.LBA_SIZE*33
-        file.seek(secondary_gpt_partition_table_offset)
-        secondary_gpt_partition_table=file.read(self.LBA_SIZE*32)
-        file.close()
-
-
-        header=GptHeader(secondary_gpt_header, 
-                        secondary_gpt_header_offset, 
-                        secondary_gpt_partition_table, 
-                        secondary_gpt_partition_table_offset)
+        # LBA -1, table is at LBA -33-(-2) if header does not say otherwise
+        disk_size=self.DISK_SECTORS*self.LBA_SIZE
+        secondary_gpt_header_offset=disk_size-self.LBA_SIZE
+        secondary_gpt_partition_table_offset=disk_size-self.LBA_SIZE*(self.default_table_lbas()+1)
+        with self.metrics.phase("secondary_read"):
+            return self.read_gpt_header(secondary_gpt_header_offset,
+                                        secondary_gpt_partition_table_offset)
+
+
+
+    # reads header and then partition table where header points:
+    # entries LBA, number of entries and entry size come from header
+    # default_table_offset is used for headers with broken fields
+    def read_gpt_header( self, gpt_header_offset, default_table_offset ):
+        source = self.open_source()
+        gpt_header = source.read(gpt_header_offset, self.LBA_SIZE)
+        entries_lba=int.from_bytes(gpt_header[0x48:0x48+8],"little")
+        entries_number=int.from_bytes(gpt_header[0x50:0x50+4],"little")
+        entry_size=int.from_bytes(gpt_header[0x54:0x54+4],"little")
+        table_size=entries_number*entry_size
+
+        gpt_partition_table_offset=entries_lba*self.LBA_SIZE
+        if (entries_lba==0 or entry_size<self.GPT_ENTRY_SIZE or entry_size%8!=0
+                or table_size==0 or table_size>self.MAX_TABLE_SIZE):
+            gpt_partition_table_offset=default_table_offset
+            table_size=self.LBA_SIZE*self.default_table_lbas()
+        gpt_partition_table = source.read(gpt_partition_table_offset, table_size)
+
+        header=GptHeader(gpt_header, gpt_header_offset,
+                        gpt_partition_table, gpt_partition_table_offset)
+        header.metrics=self.metrics
         return header
 
 
 
+    # number of sectors in default partition table
+    def default_table_lbas( self ):
+        return -(-self.GPT_TABLE_SIZE//self.LBA_SIZE)
+
+
+
+    # entry size of the header or default one if header is broken
+    def header_entry_size( self, header ):
+        if header.entry_size>=self.GPT_ENTRY_SIZE and header.entry_size%8==0:
+            return header.entry_size
+        return self.GPT_ENTRY_SIZE
+
+
+
     # parse partition table into single entries, save to objects GPTPartition
-    # and then save it in dictionary PARTITIONS_LIST as unique_guid:partition
-    # is_primary variable needed to calculate offsets properly
-    def append_partitions_list( self, raw_partition_table, is_primary ):
-        # GUIDs of 128 partitions. One partition entry is 128 bytes.
-        offset=None
-        if is_primary:
-            offset=self.LBA_SIZE*2
-        else:
-            offset=DISK_SECTORS*512-self.LBA_SIZE*33
-        number=1
-        for i in range(0,self.LBA_SIZE*32,self.GPT_ENTRY_SIZE):
-            entry=raw_partition_table[i:i+self.GPT_ENTRY_SIZE]
-
-            # this field has mixed endian
-            # first part in little-endian
-            guid_first_part = entry[0:8]
-            # second part in big_endian
-            guid_last_part = entry[8:16]
-            guid = []
-            # reverse first_part
-            guid.append(guid_first_part[0:4][::-1].hex())
-            guid.append(guid_first_part[4:6][::-1].hex())
-            guid.append(guid_first_part[6:8][::-1].hex())
-            # don't reverse second part
-            guid.append(guid_last_part[0:2].hex())
-            guid.append(guid_last_part[2:8].hex())
-            # join parts for standard style
-            guid_string="-".join(guid)
-            unique_guid=entry[16:32].hex()
-
-            # flag for founded secret partitions
-            is_secret=False
-            # search for gpt_secret_partition pertitions
-            if unique_guid=="0"*32 and self.SEARCH_SECRET:
-                secret_guid=entry[len(entry)-32:len(entry)-16]
-                secret_unique_guid=entry[len(entry)-16:len(entry)]
-                guid_first_part = secret_guid[0:8]
-
-                guid_last_part = secret_guid[8:16]
-                guid = []
-
-                guid.append(guid_first_part[0:4][::-1].hex())
-                guid.append(guid_first_part[4:6][::-1].hex())
-                guid.append(guid_first_part[6:8][::-1].hex())
-
-                guid.append(guid_last_part[0:2].hex())
-                guid.append(guid_last_part[2:8].hex())
-
-                guid_string="-".join(guid)
-                unique_guid=secret_unique_guid.hex()
-                if not unique_guid=="0"*32:
-                    is_secret=True
-
-
-            # if there is an actual partition
-            if not unique_guid == "0"*32:
-                partition=None
+    # and then save it in dictionary PARTITIONS_LIST as raw unique_guid:partition
+    # is_primary variable needed to know which block of partition to fill
+    def append_partitions_list( self, header, is_primary ):
+        with self.metrics.phase("entry_decode"):
+            entry_size=self.header_entry_size(header)
+            entries_number=header.entries_number
+            if entry_size!=header.entry_size or entries_number*entry_size>len(header.partition_table):
+                entries_number=len(header.partition_table)//entry_size
+            table=header.partition_table
+
+            # only used entries are returned, fields are decoded by GptPartition lazily
+            for i, type_guid, unique_guid, is_secret in decode_partition_entries(
+                    table, entry_size, entries_number, self.SEARCH_SECRET):
                 # check if it is inside PARTITIONS_LIST
-                known_partition = self.PARTITIONS_LIST.get(unique_guid)
+                partition = self.PARTITIONS_LIST.get(unique_guid)
                 # if not - creating object
-                if not known_partition:
-                    partition=GptPartition()
-                    partition.guid=guid_string.upper()
-                    partition.unique_guid=unique_guid.upper()
-                    self.PARTITIONS_LIST.update({unique_guid:partition})
-                # if it is inside PARTITION_LIST - work with it
-                if known_partition:
-                    partition=known_partition
+                if partition is None:
+                    partition=GptPartition(entry_size)
+                    self.PARTITIONS_LIST[unique_guid]=partition
                 # update info about offsets and block
-                if is_primary:
-                    partition.primary_block=entry
-                    partition.primary_offset=offset
-                if not is_primary:
-                    partition.secondary_block=entry
-                    partition.secondary_offset=offset
+                partition.set_entry(is_primary, table, i*entry_size,
+                                    header.partition_table_offset+i*entry_size)
                 if is_secret:
                     partition.is_secret=True
-            number=number+1
-            offset=offset+self.GPT_ENTRY_SIZE
-        
 
 
-def main( args ):
-    reader = None
-    try:
-        reader=GptReader(args[1],False)
-    except IndexError:
-        print("USAGE: sudo python3 gpt_reader.py DISK_PATH(/dev/sdX)")
-        exit(-1)
 
-    if not reader.verify_gpt():
-        print(args[1]+" is not a GPT disk")
-        exit(-1)
+# scan of one disk split into steps: open, protective MBR check, primary
+# and secondary header with their tables. scan() runs all of them, other
+# tools add their work between steps (cache lookups, deadlines, probing)
+# and keep reader and headers for more reads or writes
+# steps raise NotGptDiskError for disks without GPT, GptError for broken
+# structures and OSError if disk can not be read
+class DiskScan( object ):
+    reader=None
+    primary=None
+    secondary=None
 
-    primary_header = reader.read_primary_gpt_header()
-    secondary_header = reader.read_secondary_gpt_header()
-    primary_header.print_info()
-    secondary_header.print_info()
+    def __init__( self, disk_path, search_secret=False, lba_size=None, use_mmap=False, direct_io=False,
+                  metrics=NULL_METRICS ):
+        self.reader=GptReader(disk_path, search_secret, use_mmap, False, lba_size, direct_io, metrics)
 
+    # runs one step, ValueError of broken fields (as negative offsets) is GptError of the disk
+    def step( self, function, *args ):
+        try:
+            return function(*args)
+        except ValueError as e:
+            raise GptError(self.reader.DISK_PATH+": "+str(e))
+
+    # opens the disk, missing disks are OSError, not NotGptDiskError
+    def open( self ):
+        self.step(self.reader.open_source)
+        return self
+
+    def verify( self ):
+        if not self.step(self.reader.verify_gpt):
+            raise NotGptDiskError(self.reader.DISK_PATH, self.reader.error)
+        return self
+
+    # reads primary or secondary header with its table, partitions are not added
+    def read_header( self, is_primary ):
+        if is_primary:
+            self.primary=self.step(self.reader.read_primary_gpt_header)
+            return self.primary
+        self.secondary=self.step(self.reader.read_secondary_gpt_header)
+        return self.secondary
+
+    # adds partitions of the header into reader.PARTITIONS_LIST
+    def add_partitions( self, header, is_primary ):
+        self.step(self.reader.append_partitions_list, header, is_primary)
+
+    def read_primary( self ):
+        header=self.read_header(True)
+        self.add_partitions(header, True)
+        return header
 
+    def read_secondary( self ):
+        header=self.read_header(False)
+        self.add_partitions(header, False)
+        return header
 
-    reader.append_partitions_list( primary_header.partition_table, True )
-    reader.append_partitions_list( secondary_header.partition_table, False)
-    
-    print("\n\nDetected partitions: "+str(len(reader.PARTITIONS_LIST)))
-    for k in reader.PARTITIONS_LIST.keys():
-        partition=reader.PARTITIONS_LIST.get(k)
-        partition.info()
+    def run( self ):
+        self.open()
+        self.verify()
+        self.read_primary()
+        self.read_secondary()
+        return self
+
+    # filesystems of (first_lba, last_lba) ranges, partitions of the disk by default
+    def probe( self, ranges=None ):
+        reader=self.reader
+        if ranges is None:
+            ranges=[(p.first_lba, p.last_lba) for p in reader.PARTITIONS_LIST.values()]
+        with reader.metrics.phase("probe"):
+            return self.step(probe_ranges, reader.open_source(), reader.LBA_SIZE, ranges)
+
+    def report( self ):
+        reader=self.reader
+        return DiskReport(reader.DISK_PATH, reader.LBA_SIZE, reader.DISK_SECTORS, reader.mbr,
+                          self.primary.report(), self.secondary.report(),
+                          tuple(p.report() for p in reader.PARTITIONS_LIST.values()))
+
+    def close( self ):
+        self.reader.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+
+
+# scans the disk without printing anything and returns DiskReport
+# raises NotGptDiskError for disks without GPT, GptError for broken
+# structures and OSError if disk can not be read
+# every call has its own reader, so scans can run in many threads at once
+def scan( disk_path, search_secret=False, lba_size=None, use_mmap=False, direct_io=False,
+          metrics=NULL_METRICS ):
+    with DiskScan(disk_path, search_secret, lba_size, use_mmap, direct_io, metrics) as disk:
+        return disk.run().report()
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Print GPT headers and partitions of the disk.")
+    parser.add_argument("path", help="disk path (/dev/sdX) or image")
+    parser.add_argument("-s", "--secret", action="store_true",
+                        help="search for partitions hidden by gpt_secret_partition")
+    output=parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true", help="print JSON report without hex dumps")
+    output.add_argument("-q", "--quiet", action="store_true", help="print one line per partition")
+    options=parser.parse_args(args[1:])
+
+    try:
+        report=scan(options.path, options.secret)
+    except NotGptDiskError as e:
+        if not options.quiet:
+            print(e.reason)
+        print(options.path+" is not a GPT disk")
+        exit(-1)
+    except (OSError, GptError) as e:
+        print(str(e))
+        exit(-1)
+
+    if options.json:
+        print(json.dumps(report_dict(report)))
+    elif options.quiet:
+        if report.partitions:
+            print(format_quiet(report))
+    else:
+        print(format_report(report))
     return None
     
 # need this if execution is not from import
 if __name__ == "__main__":
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,286 @@
+# Comparing and repairing primary and backup GPT (for Python 3)
+# USAGE: sudo python3 gpt_repair.py [-r] [--from primary|secondary] [--json] DISK_PATH(/dev/sdX) ...
+# Both copies are compared and differences are reported. With -r the
+# damaged copy is rebuilt from the good one, only changed sectors are written
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import sys
+import json
+import argparse
+
+from gpt_checksum import header_crc32
+from gpt_metrics import NULL_METRICS
+from gpt_write import WritePlan
+from gpt_write import has_journal
+from gpt_write import rollback
+from gpt_reader import DiskScan
+from gpt_report import GptError
+from gpt_report import NotGptDiskError
+
+
+
+# header fields which must be the same in both copies: (name, start, end)
+# current_lba, backup_lba and entries_lba are checked against disk layout
+SHARED_HEADER_FIELDS=(
+    ("signature", 0x00, 0x08),
+    ("revision", 0x08, 0x0C),
+    ("header_size", 0x0C, 0x10),
+    ("first_usable_lba", 0x28, 0x30),
+    ("last_usable_lba", 0x30, 0x38),
+    ("disk_guid", 0x38, 0x48),
+    ("entries_number", 0x50, 0x54),
+    ("entry_size", 0x54, 0x58),
+    ("entries_checksum", 0x58, 0x5C)
+)
+
+
+
+# compares byte buffers without copying them
+# memoryview of bytes compares byte by byte, 8-byte items are much faster
+def same_bytes( first, second ):
+    if len(first)!=len(second):
+        return False
+    first=memoryview(first)
+    second=memoryview(second)
+    if len(first)%8==0:
+        return first.cast("Q")==second.cast("Q")
+    return first==second
+
+
+
+# indexes of entries which differ in two tables of the same size
+def differing_entries( first_table, second_table, entry_size ):
+    first=memoryview(first_table)
+    second=memoryview(second_table)
+    length=min(len(first), len(second))//entry_size*entry_size
+    return [start//entry_size for start in range(0, length, entry_size)
+            if not same_bytes(first[start:start+entry_size], second[start:start+entry_size])]
+
+
+
+# names of shared header fields which differ
+def differing_header_fields( primary_header, secondary_header ):
+    return [name for name, start, end in SHARED_HEADER_FIELDS
+            if primary_header.gpt_header[start:end]!=secondary_header.gpt_header[start:end]]
+
+
+
+# names of location fields of header which do not match its place on disk
+def misplaced_header_fields( header, current_lba, backup_lba ):
+    fields=[ ]
+    if header.current_lba!=current_lba:
+        fields.append("current_lba")
+    if header.backup_lba!=backup_lba:
+        fields.append("backup_lba")
+    return fields
+
+
+
+# report of primary and secondary GPT of the disk: validity of every copy,
+# differing header fields and entries, and which copy is damaged
+# healthy disk costs one comparison of tables and a few of header fields
+def compare_copies( reader, primary_header, secondary_header ):
+    last_lba=reader.DISK_SECTORS-1
+    report=dict()
+    with reader.metrics.phase("compare"):
+        for name, header, current_lba, backup_lba in (
+                ("primary", primary_header, 1, last_lba),
+                ("secondary", secondary_header, last_lba, 1)):
+            header_ok, entries_ok = header.validate()
+            report[name]={
+                "header_checksum_ok":header_ok,
+                "entries_checksum_ok":entries_ok,
+                "misplaced_fields":misplaced_header_fields(header, current_lba, backup_lba)
+            }
+        report["header_fields"]=differing_header_fields(primary_header, secondary_header)
+        report["entries"]=[ ]
+        if not same_bytes(primary_header.partition_table, secondary_header.partition_table):
+            report["entries"]=differing_entries(primary_header.partition_table,
+                                                secondary_header.partition_table,
+                                                reader.header_entry_size(primary_header))
+            # tables of different size differ even if common entries are the same
+            if not report["entries"]:
+                report["entries"]=None
+
+    for name in ("primary", "secondary"):
+        copy=report[name]
+        copy["ok"]=(copy["header_checksum_ok"] and copy["entries_checksum_ok"]
+                    and not copy["misplaced_fields"])
+    report["consistent"]=(report["primary"]["ok"] and report["secondary"]["ok"]
+                          and not report["header_fields"] and report["entries"]==[ ])
+    # empty for inconsistent disk if both copies have correct checksums, but say different things
+    report["damaged"]=[name for name in ("primary", "secondary") if not report[name]["ok"]]
+    return report
+
+
+
+# copy which repair takes as correct: the only one with correct checksums, or
+# the only one at right place if both say the same. None if copies with correct
+# checksums say different things, then user chooses the copy with --from
+def repair_source( report ):
+    valid=[name for name in ("primary", "secondary")
+           if report[name]["header_checksum_ok"] and report[name]["entries_checksum_ok"]]
+    if len(valid)==1:
+        return valid[0]
+    if len(valid)==2 and not report["header_fields"] and report["entries"]==[ ]:
+        placed=[name for name in valid if report[name]["ok"]]
+        if len(placed)==1:
+            return placed[0]
+    return None
+
+
+
+# header sector of the copy at current_lba with entries at entries_lba,
+# other fields are taken from the source header
+def rebuilt_header( header, lba_size, current_lba, backup_lba, entries_lba ):
+    sector=bytearray(header.gpt_header[0:lba_size])
+    sector[0x18:0x20]=current_lba.to_bytes(8,"little")
+    sector[0x20:0x28]=backup_lba.to_bytes(8,"little")
+    sector[0x48:0x50]=entries_lba.to_bytes(8,"little")
+    sector[0x10:0x14]=header_crc32(sector).to_bytes(4,"little")
+    return sector
+
+
+
+# adds sectors of new_bytes which differ from disk to the plan
+def plan_changed_sectors( plan, reader, offset, new_bytes ):
+    lba_size=reader.LBA_SIZE
+    sectors=-(-len(new_bytes)//lba_size)
+    current=reader.open_source().read(offset, sectors*lba_size)
+    if same_bytes(current[0:len(new_bytes)], new_bytes):
+        return 0
+    new_view=memoryview(new_bytes)
+    changed=0
+    for start in range(0, len(new_bytes), lba_size):
+        new_sector=new_view[start:start+lba_size]
+        if not same_bytes(current[start:start+len(new_sector)], new_sector):
+            # tail of the last sector stays as it is on disk
+            sector=bytearray(current[start:start+lba_size])
+            sector[0:len(new_sector)]=new_sector
+            plan.add(offset+start, sector)
+            changed+=1
+    return changed
+
+
+
+# plans both copies of GPT rebuilt from source header
+# source copy gets new location fields only if they are wrong,
+# so usually only sectors of damaged copy are written
+def plan_repair( plan, reader, primary_header, secondary_header, source="primary" ):
+    header=primary_header if source=="primary" else secondary_header
+    lba_size=reader.LBA_SIZE
+    last_lba=reader.DISK_SECTORS-1
+    entry_size=reader.header_entry_size(header)
+    table=header.partition_table[0:header.entries_number*entry_size]
+    table_lbas=-(-len(table)//lba_size)
+
+    # primary entries stay where they are, backup entries are right before backup header
+    primary_entries_lba=primary_header.entries_lba
+    if source!="primary" or primary_entries_lba<2:
+        primary_entries_lba=2
+    secondary_entries_lba=last_lba-table_lbas
+
+    changed=0
+    for current_lba, backup_lba, entries_lba in ((1, last_lba, primary_entries_lba),
+                                                 (last_lba, 1, secondary_entries_lba)):
+        changed+=plan_changed_sectors(plan, reader, current_lba*lba_size,
+            rebuilt_header(header, lba_size, current_lba, backup_lba, entries_lba))
+        changed+=plan_changed_sectors(plan, reader, entries_lba*lba_size, table)
+    return changed
+
+
+
+# compares copies and repairs damaged one if repair is True
+# source is "primary", "secondary" or None to choose it by checksums
+# returns report with "repaired" list of written (offset, length)
+def check_disk( disk_path, repair=False, source=None, metrics=NULL_METRICS ):
+    disk=DiskScan(disk_path, metrics=metrics)
+    try:
+        report={"path":disk_path}
+        try:
+            disk.open().verify()
+        except NotGptDiskError:
+            report["gpt"]=False
+            return report
+        report["gpt"]=True
+        reader=disk.reader
+        primary_header=disk.read_header(True)
+        secondary_header=disk.read_header(False)
+        report.update(compare_copies(reader, primary_header, secondary_header))
+        if not repair or report["consistent"]:
+            return report
+
+        source=source or repair_source(report)
+        if source is None:
+            raise ValueError("Both GPT copies of "+disk_path+" are damaged or differ, choose source copy with --from")
+        if not reader.source.writable:
+            raise ValueError("Image format of "+disk_path+" can not be repaired in place")
+        plan=WritePlan()
+        plan_repair(plan, reader, primary_header, secondary_header, source)
+    finally:
+        disk.close()
+    report["source"]=source
+    report["repaired"]=plan.commit(disk_path, metrics=metrics)
+    return report
+
+
+
+def print_report( report ):
+    print(report["path"]+":")
+    if not report["gpt"]:
+        print("  not a GPT disk")
+        return
+    for name in ("primary", "secondary"):
+        copy=report[name]
+        print("  "+name+": header checksum "+("ok" if copy["header_checksum_ok"] else "WRONG")
+              +", entries checksum "+("ok" if copy["entries_checksum_ok"] else "WRONG")
+              +"".join(", wrong "+field for field in copy["misplaced_fields"]))
+    if report["consistent"]:
+        print("  primary and secondary GPT are consistent")
+        return
+    if report["header_fields"]:
+        print("  differing header fields: "+", ".join(report["header_fields"]))
+    if report["entries"] is None:
+        print("  partition tables have different sizes")
+    elif report["entries"]:
+        print("  differing entries: "+", ".join(str(i) for i in report["entries"]))
+    if "repaired" in report:
+        print("  rebuilt from "+report["source"]+", written sectors ranges: "+
+              ", ".join(str(offset)+"+"+str(length) for offset, length in report["repaired"]))
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Compare primary and backup GPT and repair damaged copy.")
+    parser.add_argument("paths", nargs="+", help="disk paths")
+    parser.add_argument("-r", "--repair", action="store_true", help="rebuild damaged copy")
+    parser.add_argument("--from", dest="source", choices=("primary", "secondary"), default=None,
+                        help="copy to rebuild from (default: the one with correct checksums)")
+    parser.add_argument("--json", action="store_true", help="print NDJSON records")
+    options=parser.parse_args(args[1:])
+
+    result=0
+    for path in options.paths:
+        try:
+            # previous repair was interrupted while writing - restore the disk first
+            if options.repair and has_journal(path):
+                print("Found journal of interrupted changes, restored ranges: "+str(rollback(path)),
+                      file=sys.stderr)
+            report=check_disk(path, options.repair, options.source)
+        except (OSError, ValueError, GptError) as e:
+            report={"path":path, "error":str(e)}
+        if "error" in report or not report["gpt"] or not (report["consistent"] or "repaired" in report):
+            result=1
+        if options.json:
+            sys.stdout.write(json.dumps(report)+"\n")
+        elif "error" in report:
+            print(path+": "+report["error"])
+        else:
+            print_report(report)
+    exit(result)
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
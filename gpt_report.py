@@ -0,0 +1,163 @@
+# Results of GPT scans and their text/JSON forms (for Python 3)
+# USAGE: see gpt_reader.scan()
+# Reports are immutable named tuples of plain values (bytes, ints, strings),
+# they do not keep disk handles or views, so they can be passed between
+# threads and kept after the disk is closed
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import collections
+
+
+
+# base of errors of GPT scans
+class GptError( Exception ):
+    pass
+
+
+
+# disk can be read, but there is no protective MBR or GPT on it
+class NotGptDiskError( GptError ):
+
+    def __init__( self, disk_path, reason ):
+        GptError.__init__(self, disk_path+" is not a GPT disk: "+reason)
+        self.disk_path=disk_path
+        self.reason=reason
+
+
+
+# protective MBR: 4 raw partition records and disk size written in it
+MbrReport=collections.namedtuple("MbrReport", ("partitions", "disk_sectors"))
+
+
+
+# GPT header with stored and calculated checksums (4 little-endian bytes each)
+class HeaderReport( collections.namedtuple("HeaderReport", (
+        "offset", "raw", "header_size", "checksum", "current_lba", "backup_lba",
+        "entries_lba", "entries_number", "entry_size", "partition_table_offset",
+        "entries_checksum", "calculated_checksum", "calculated_entries_checksum")) ):
+    __slots__=()
+
+    @property
+    def checksum_ok( self ):
+        return self.checksum==self.calculated_checksum
+
+    @property
+    def entries_checksum_ok( self ):
+        return self.entries_checksum==self.calculated_entries_checksum
+
+
+
+# partition with decoded fields and raw entries of both tables (None if missing)
+PartitionReport=collections.namedtuple("PartitionReport", (
+    "unique_guid", "guid", "type", "name", "first_lba", "last_lba", "attributes",
+    "is_secret", "primary_offset", "secondary_offset", "primary_entry", "secondary_entry"))
+
+
+
+DiskReport=collections.namedtuple("DiskReport", (
+    "path", "lba_size", "disk_sectors", "mbr", "primary", "secondary", "partitions"))
+
+
+
+def header_dict( header, raw=False ):
+    result={
+        "offset":header.offset,
+        "current_lba":header.current_lba,
+        "backup_lba":header.backup_lba,
+        "entries_lba":header.entries_lba,
+        "entries_number":header.entries_number,
+        "entry_size":header.entry_size,
+        "partition_table_offset":header.partition_table_offset,
+        "checksum":header.checksum.hex(),
+        "checksum_ok":header.checksum_ok,
+        "entries_checksum":header.entries_checksum.hex(),
+        "entries_checksum_ok":header.entries_checksum_ok
+    }
+    if raw:
+        result["raw"]=header.raw.hex()
+    return result
+
+
+
+def partition_dict( partition, raw=False ):
+    result=partition._asdict()
+    del result["primary_entry"]
+    del result["secondary_entry"]
+    if raw:
+        for name in ("primary_entry", "secondary_entry"):
+            entry=getattr(partition, name)
+            result[name]=entry.hex() if entry is not None else None
+    return result
+
+
+
+# report as dictionary for json output, hex dumps only with raw=True
+def report_dict( report, raw=False ):
+    return {
+        "path":report.path,
+        "gpt":True,
+        "lba_size":report.lba_size,
+        "disk_sectors":report.disk_sectors,
+        "primary":header_dict(report.primary, raw),
+        "secondary":header_dict(report.secondary, raw),
+        "partitions":[partition_dict(partition, raw) for partition in report.partitions]
+    }
+
+
+
+# text of gpt_reader.py, as verify_gpt, GptHeader.print_info and GptPartition.info print it
+def format_mbr( report ):
+    lines=["MBR signature found.", "", "MBR Partition table: "]
+    lines+=[record.hex() for record in report.mbr.partitions]
+    lines+=["", "Disk size in sectors (if not - you are not running a GPT disk): "+str(report.mbr.disk_sectors),
+            "Signature of first MBR partition: ee",
+            "GPT disk found on "+report.path+".", ""]
+    return "\n".join(lines)
+
+
+
+def format_header( header ):
+    return "\n".join([
+        "\n\nGPT header ("+str(header.offset)+"): ",
+        header.raw.hex(),
+        "Header size: "+str(header.header_size),
+        "Checksum: "+header.checksum.hex(),
+        "Current LBA: "+str(header.current_lba),
+        "Backup LBA: "+str(header.backup_lba),
+        "Entries number: "+str(header.entries_number),
+        "Entry size: "+str(header.entry_size),
+        "Partition table offset: "+str(header.partition_table_offset),
+        "Partition table checksum: "+header.entries_checksum.hex(),
+        "\nCalculated header checksum: "+header.calculated_checksum.hex(),
+        "Calculated partition table checksum: "+header.calculated_entries_checksum.hex()])
+
+
+
+def format_partition( partition ):
+    lines=["\n-------------"+partition.unique_guid+" : "+partition.guid+"-------------",
+           "\n"+str(partition.primary_offset)+":"]
+    if partition.primary_entry is not None:
+        lines.append(partition.primary_entry.hex())
+    lines.append("\n"+str(partition.secondary_offset)+":")
+    if partition.secondary_entry is not None:
+        lines.append(partition.secondary_entry.hex())
+    return "\n".join(lines)
+
+
+
+def format_report( report ):
+    parts=[format_mbr(report), format_header(report.primary), format_header(report.secondary),
+           "\n\nDetected partitions: "+str(len(report.partitions))]
+    parts+=[format_partition(partition) for partition in report.partitions]
+    return "\n".join(parts)
+
+
+
+# one line per partition, without hex dumps
+def format_quiet( report ):
+    return "\n".join(" ".join([partition.unique_guid, partition.guid, partition.type,
+                               str(partition.first_lba)+"-"+str(partition.last_lba), partition.name]
+                              +(["secret"] if partition.is_secret else [ ]))
+                     for partition in report.partitions)
@@ -5,10 +5,23 @@
 # Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
 
 import sys
+import json
+import argparse
 
 from gpt_structures import GptHeader
 from gpt_structures import GptPartition
+from gpt_structures import unique_guid_key
+from gpt_checksum import header_crc32
+from gpt_metrics import NULL_METRICS
+from gpt_write import WritePlan
+from gpt_write import has_journal
+from gpt_write import rollback
 from gpt_reader import GptReader
+from gpt_reader import DiskScan
+from gpt_reader import scan
+from gpt_report import GptError
+from gpt_report import report_dict
+from gpt_report import format_quiet
 from partition_type import PartitionType
 
 
@@ -16,7 +29,32 @@ from partition_type import PartitionType
 # hides partition from applications such as fdisk, gparted
 # prevents them from mounting
 # only gpt_reader knows where to look to find hidden partitions
-def hide_partition( disk_path, primary_header, secondary_header, partition, hide ):
+# metrics (gpt_metrics) collects checksum and write timings and write counters
+def hide_partition( disk_path, primary_header, secondary_header, partition, hide, metrics=NULL_METRICS,
+                    journal_path=None ):
+    hide_partitions(disk_path, primary_header, secondary_header, [(partition, hide)], metrics, journal_path)
+
+
+
+# hides or unhides many partitions with one write plan:
+# all changes are merged and written in offset order with one fsync,
+# so 50 partitions cost about as much as one
+# changes is list of (partition, hide)
+# raises GptError for compressed images and containers
+# journal_path is where undo journal is kept (default: gpt_write.default_journal_path)
+def hide_partitions( disk_path, primary_header, secondary_header, changes, metrics=NULL_METRICS,
+                     journal_path=None ):
+    plan=WritePlan()
+    for partition, hide in changes:
+        plan_hide_partition(plan, primary_header, secondary_header, partition, hide, metrics)
+    plan.commit(disk_path, journal_path, metrics)
+    for partition, hide in changes:
+        partition.is_secret=hide
+
+
+
+# adds changes of hiding one partition into WritePlan
+def plan_hide_partition( plan, primary_header, secondary_header, partition, hide, metrics=NULL_METRICS ):
 
     # partitions entries are the same - we can use only one
     primary_block=partition.primary_block
@@ -32,72 +70,104 @@ def hide_partition( disk_path, primary_header, secondary_header, partition, hide
         new_guids=primary_block[len(partition.primary_block)-32:len(partition.primary_block)]
 
     # creating block with guids at the end
-    new_block=new_guids+primary_block[32:len(primary_block)-32]+guids
+    # blocks can be memoryviews of the disk source, so join them
+    new_block=b''.join([new_guids, primary_block[32:len(primary_block)-32], guids])
     
     # now we need to insert this block into partition table
     # this is relative offset inside a patritions table
     offset_in_table = partition.primary_offset-primary_header.partition_table_offset
 
-    # need to create field with table to calculate checksum
-    new_partition_table=primary_header.partition_table[0:offset_in_table]+new_block+primary_header.partition_table[offset_in_table+primary_header.entry_size:len(primary_header.partition_table)]
-    new_partition_checksum=primary_header.calculate_partition_table_checksum(new_partition_table)
-    
-    # now create headers with previous checksum and calculate
-    # new checksum with it
-    new_primary_header=primary_header.gpt_header[0:0x58]+new_partition_checksum+primary_header.gpt_header[0x5C:primary_header.header_size]
-    new_primary_checksum=primary_header.calculate_checksum(new_primary_header)
-
-    new_secondary_header=secondary_header.gpt_header[0:0x58]+new_partition_checksum+secondary_header.gpt_header[0x5C:secondary_header.header_size]
-    new_secondary_checksum=secondary_header.calculate_checksum(new_secondary_header)
-
-
-    # now we need to insert new partition block in both tables
-    # and new checksums in both headers
-    # r+ mode allows to write inside of file
-    disk = open(disk_path,"r+b")
-
-    # seek primary header checksum
-    disk.seek(primary_header.gpt_header_offset+0x10)
-    disk.write(new_primary_checksum)
-    disk.seek(0)
-
-    # seek primary header partition table checksum
-    disk.seek(primary_header.gpt_header_offset+0x58)
-    disk.write(new_partition_checksum)
-    disk.seek(0)
-
-    # seek partition inside partition table
-    disk.seek(primary_header.partition_table_offset+offset_in_table)
-    disk.write(new_block)
-    disk.seek(0)
-
-    # seek secondary partition inside secondary partition table
-    disk.seek(secondary_header.partition_table_offset+offset_in_table)
-    disk.write(new_block)
-    disk.seek(0)
-
-    # seek secondary header checksum
-    disk.seek(secondary_header.gpt_header_offset+0x10)
-    disk.write(new_secondary_checksum)
-    disk.seek(0)
-
-    # seek secondary header partition table checksum
-    disk.seek(secondary_header.gpt_header_offset+0x58)
-    disk.write(new_partition_checksum)
-
-    disk.close()
+    # table checksum is updated only with changed entry,
+    # engine stays in header for next edits of the same table
+    # table_checksum() times its first full pass itself, so it is out of the phase
+    table_checksum=primary_header.table_checksum()
+    with metrics.phase("checksum"):
+        table_checksum.update_entry(offset_in_table//primary_header.entry_size, new_block)
+        new_partition_checksum=table_checksum.checksum()
+
+        # headers with new table checksum and their new checksums
+        new_primary_header=updated_header(primary_header, new_partition_checksum)
+        new_secondary_header=updated_header(secondary_header, new_partition_checksum)
+
+    # new partition block in both tables and new headers
+    # headers of later changes overwrite these ones in the plan
+    plan.add(primary_header.gpt_header_offset, new_primary_header)
+    plan.add(primary_header.partition_table_offset+offset_in_table, new_block)
+    plan.add(secondary_header.partition_table_offset+offset_in_table, new_block)
+    plan.add(secondary_header.gpt_header_offset, new_secondary_header)
+
+
+
+# header bytes with new partition table checksum and header checksum
+def updated_header( header, partition_checksum ):
+    new_header=bytearray(header.gpt_header[0:header.header_size])
+    new_header[0x58:0x5C]=partition_checksum
+    new_header[0x10:0x14]=header_crc32(header.gpt_header, partition_checksum).to_bytes(4,"little")
+    return new_header
+
+
+
+# hides (or unhides) partitions given by unique guids without any questions
+# raises GptError for unknown partitions and partitions which are already hidden
+# (or not hidden), returns DiskReport of the changed disk
+def set_hidden( disk_path, unique_guids, hide, metrics=NULL_METRICS ):
+    with DiskScan(disk_path, True, metrics=metrics) as disk:
+        reader=disk.run().reader
+        partitions=[ ]
+        for guid in unique_guids:
+            try:
+                partition=reader.PARTITIONS_LIST.get(bytes.fromhex(unique_guid_key(guid)))
+            except ValueError:
+                partition=None
+            if partition is None:
+                raise GptError("There is no partition "+guid+" on "+disk_path)
+            if partition.is_secret==hide:
+                raise GptError("Partition "+guid+" is already "+("hidden" if hide else "not hidden"))
+            partitions.append(partition)
+        hide_partitions(disk_path, disk.primary, disk.secondary,
+                        [(partition, hide) for partition in partitions], metrics)
+    return scan(disk_path, True)
 
 
 
 def main( args ):
-    reader = None
-    try:
-        reader=GptReader(args[1],True)
-    except IndexError:
-        print("USAGE: sudo python3 gpt_secret_partition.py DISK_PATH(/dev/sdX)")
-        exit(-1)
+    parser=argparse.ArgumentParser(description="Hide GPT partitions from other tools or unhide them. "
+                                               "Without options works as interactive menu.")
+    parser.add_argument("path", help="disk path (/dev/sdX) or image")
+    action=parser.add_mutually_exclusive_group()
+    action.add_argument("-l", "--list", action="store_true", help="print partitions, hidden ones too")
+    action.add_argument("--hide", metavar="GUID[,GUID]", help="hide partitions with these unique guids")
+    action.add_argument("--unhide", metavar="GUID[,GUID]", help="unhide partitions with these unique guids")
+    parser.add_argument("--json", action="store_true", help="print JSON report instead of lines")
+    options=parser.parse_args(args[1:])
+
+    # previous run was interrupted while writing - restore the disk first
+    if has_journal(options.path):
+        try:
+            print("Found journal of interrupted changes, restored ranges: "+str(rollback(options.path)))
+        except (OSError, GptError) as e:
+            print(str(e))
+            exit(-1)
+
+    if options.list or options.hide or options.unhide:
+        try:
+            if options.list:
+                report=scan(options.path, True)
+            else:
+                guids=[g.strip() for g in (options.hide or options.unhide).split(",") if g.strip()]
+                report=set_hidden(options.path, guids, bool(options.hide))
+        except (OSError, GptError) as e:
+            print(str(e))
+            exit(-1)
+        if options.json:
+            print(json.dumps(report_dict(report)))
+        elif report.partitions:
+            print(format_quiet(report))
+        exit(0)
+
+    reader=GptReader(options.path,True)
     if not reader.verify_gpt():
-        print(args[1]+" is not a GPT disk")
+        print(options.path+" is not a GPT disk")
         exit(-1)
 
     primary_header = reader.read_primary_gpt_header()
@@ -105,8 +175,8 @@ def main( args ):
     primary_header.print_info()
     secondary_header.print_info()
 
-    reader.append_partitions_list( primary_header.partition_table, True )
-    reader.append_partitions_list( secondary_header.partition_table, False)
+    reader.append_partitions_list( primary_header, True )
+    reader.append_partitions_list( secondary_header, False)
     
     # interactive interface
     while True:
@@ -115,7 +185,7 @@ def main( args ):
         number=1
         for k in keys:
             partition=reader.PARTITIONS_LIST.get(k)
-            type=PartitionType.type(partition.guid)
+            type=PartitionType.type(partition.type_guid)
             secret=None
             if partition.is_secret:
                 secret="Secret partition"
@@ -124,31 +194,37 @@ def main( args ):
             print(str(number)+": "+partition.unique_guid+" "+partition.guid+" "+type+" "+secret)
             number=number+1
 
-        # user choses partition to work with or exit
-        choice=input("Choose partition (E for exit): ")
+        # user choses partitions to work with or exit
+        choice=input("Choose partitions, like 1 or 1,3,5 (E for exit): ")
         if str(choice).upper()=='E':
             exit(0)
-        choice=int(choice)
-        partition=reader.PARTITIONS_LIST.get(keys[choice-1])
+        partitions=[reader.PARTITIONS_LIST.get(keys[int(c)-1]) for c in choice.split(",") if c.strip()]
         print("Partition info: ")
-        partition.info()
+        for partition in partitions:
+            partition.info()
 
         # menu - hide or unhide partitions or exit
         choice=input("\nWhat to do: \n(H)Hide\n(U)Unhide\n(B)Back\n(E)Exit\n: ").upper()
         if choice=='B':
             continue
         if choice=='H':
-            # if it is already hidden
-            if partition.is_secret:
+            # if some of them is already hidden
+            if any(partition.is_secret for partition in partitions):
                 print("\n\nERROR: YOU CAN NOT HIDE SECRET PARTITION")
                 continue
-            hide_partition(args[1],primary_header,secondary_header,partition,True)
+            changes=[(p,True) for p in partitions]
         if choice=='U':
-            # if it is already unhidden
-            if not partition.is_secret:
+            # if some of them is already unhidden
+            if not all(partition.is_secret for partition in partitions):
                 print("\n\nERROR: YOU CAN NOT UNHIDE NOT SECRET PARTITION")
                 continue
-            hide_partition(args[1],primary_header,secondary_header,partition,False)
+            changes=[(p,False) for p in partitions]
+        if choice in ('H', 'U'):
+            try:
+                hide_partitions(options.path,primary_header,secondary_header,changes)
+            except GptError as e:
+                print(str(e))
+                exit(-1)
         exit(0)
 
 
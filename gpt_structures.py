@@ -5,32 +5,192 @@
 # Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
 
 import zlib
+import uuid
+import struct
+import itertools
+import operator
+
+from gpt_checksum import header_crc32
+from gpt_checksum import validate_header
+from gpt_checksum import PartitionTableChecksum
+from gpt_metrics import NULL_METRICS
+from gpt_report import HeaderReport
+from gpt_report import PartitionReport
+from gpt_report import format_header
+from gpt_report import format_partition
+from partition_type import PartitionType
+
+
+# unused entries have zero unique guid
+ZERO_GUID=bytes(16)
+
+
+# converts raw on-disk guid into standard string
+# first three fields are little-endian, the rest is big-endian
+def guid_to_string( raw_guid ):
+    first, second, third = struct.unpack_from("<IHH", raw_guid)
+    return "%08X-%04X-%04X-%s-%s" % (first, second, third,
+                                     bytes(raw_guid[8:10]).hex().upper(),
+                                     bytes(raw_guid[10:16]).hex().upper())
+
+
+
+# unique guid as GptPartition.unique_guid (hex of raw bytes), also from
+# standard string like 01234567-89AB-CDEF-0123-456789ABCDEF
+def unique_guid_key( guid ):
+    guid=guid.strip("{}")
+    if "-" in guid:
+        try:
+            return uuid.UUID(guid).bytes_le.hex().upper()
+        except ValueError:
+            pass
+    return guid.upper()
+
+
+# decodes the whole partition entries array in one pass
+# returns list of (index, type guid, unique guid, is_secret) for used entries only
+# with search_secret entries with zero guids are checked for
+# guids at the end of entry (as gpt_secret_partition hides them)
+def decode_partition_entries( partition_table, entry_size, entries_number, search_secret ):
+    entries_number=min(entries_number, len(partition_table)//entry_size)
+    table=memoryview(partition_table)[0:entries_number*entry_size]
+    if search_secret:
+        layout="<16s16s"+str(entry_size-64)+"x16s16s"
+    else:
+        layout="<16s16s"+str(entry_size-32)+"x"
+    fields=list(struct.iter_unpack(layout, table))
+    unique_guids=[f[1] for f in fields]
+
+    used=[ ]
+    # index of entries with non-zero unique guid, without python loop over empty slots
+    normal=itertools.compress(range(entries_number), map(ZERO_GUID.__ne__, unique_guids))
+    for i in normal:
+        used.append((i, fields[i][0], fields[i][1], False))
+    if search_secret:
+        secret_guids=[f[3] for f in fields]
+        secret=itertools.compress(range(entries_number),
+            map(operator.and_, map(ZERO_GUID.__eq__, unique_guids), map(ZERO_GUID.__ne__, secret_guids)))
+        for i in secret:
+            used.append((i, fields[i][2], fields[i][3], True))
+        used.sort()
+    return used
 
 
 
 # structure for saving detected GPT partitions
+# keeps only views of partition tables and offsets of the entry,
+# all fields are decoded from entry when they are asked for
 class GptPartition( object ):
-    guid=None
-    unique_guid=None
-    primary_block=None
-    secondary_block=None
-    primary_offset=None
-    secondary_offset=None
-
-    # this is a flag for gpt_secret_partition partitions
-    # gpt_reader sets it if working in SEARCH_SECRET mode
-    is_secret=False
+    __slots__=("entry_size", "is_secret",
+               "primary_table", "primary_start", "primary_offset",
+               "secondary_table", "secondary_start", "secondary_offset")
 
+    # is_secret is a flag for gpt_secret_partition partitions
+    # gpt_reader sets it if working in SEARCH_SECRET mode
     # initiates correctly through GptReader.append_partitions_list()
-    # def __init__( self ):
-        # pass
+    def __init__( self, entry_size, is_secret=False ):
+        self.entry_size=entry_size
+        self.is_secret=is_secret
+        self.primary_table=None
+        self.primary_start=None
+        self.primary_offset=None
+        self.secondary_table=None
+        self.secondary_start=None
+        self.secondary_offset=None
+
+    # sets the entry of partition in primary or secondary table:
+    # table view, start of entry inside of it and offset of entry on disk
+    def set_entry( self, is_primary, table, start, offset ):
+        if is_primary:
+            self.primary_table=table
+            self.primary_start=start
+            self.primary_offset=offset
+        else:
+            self.secondary_table=table
+            self.secondary_start=start
+            self.secondary_offset=offset
+
+    @property
+    def primary_block( self ):
+        if self.primary_table is None:
+            return None
+        return self.primary_table[self.primary_start:self.primary_start+self.entry_size]
+
+    @property
+    def secondary_block( self ):
+        if self.secondary_table is None:
+            return None
+        return self.secondary_table[self.secondary_start:self.secondary_start+self.entry_size]
+
+    # entry used for decoding fields, primary if it is known
+    @property
+    def block( self ):
+        if self.primary_table is not None:
+            return self.primary_block
+        return self.secondary_block
+
+    # guids of hidden entries are moved to the end of entry
+    def guids_start( self, block ):
+        if block[16:32]==ZERO_GUID:
+            return self.entry_size-32
+        return 0
+
+    # raw on-disk bytes of type guid for PartitionType lookups
+    @property
+    def type_guid( self ):
+        block=self.block
+        start=self.guids_start(block)
+        return bytes(block[start:start+16])
+
+    @property
+    def unique_guid_bytes( self ):
+        block=self.block
+        start=self.guids_start(block)+16
+        return bytes(block[start:start+16])
+
+    # type guid in standard form
+    @property
+    def guid( self ):
+        return guid_to_string(self.type_guid)
+
+    @property
+    def unique_guid( self ):
+        return self.unique_guid_bytes.hex().upper()
+
+    @property
+    def first_lba( self ):
+        return struct.unpack_from("<Q", self.block, 0x20)[0]
+
+    @property
+    def last_lba( self ):
+        return struct.unpack_from("<Q", self.block, 0x28)[0]
+
+    @property
+    def attributes( self ):
+        return struct.unpack_from("<Q", self.block, 0x30)[0]
+
+    # UTF-16 name, hidden partitions lose the end of it
+    @property
+    def name( self ):
+        block=self.block
+        end=min(self.entry_size, 0x38+72)
+        if self.guids_start(block):
+            end=min(end, self.entry_size-32)
+        name=bytes(block[0x38:end]).decode("utf-16-le", "replace")
+        return name.split("\0",1)[0]
+
+    # immutable copy of decoded fields and raw entries (gpt_report)
+    def report( self ):
+        primary_block=self.primary_block
+        secondary_block=self.secondary_block
+        return PartitionReport(self.unique_guid, self.guid, PartitionType.type(self.type_guid),
+                               self.name, self.first_lba, self.last_lba, self.attributes,
+                               self.is_secret, self.primary_offset, self.secondary_offset,
+                               bytes(primary_block) if primary_block is not None else None,
+                               bytes(secondary_block) if secondary_block is not None else None)
 
     def info( self ):
-        print("\n-------------"+self.unique_guid+" : "+self.guid+"-------------")
-        print("\n"+str(self.primary_offset)+":")
-        print(self.primary_block.hex())
-        print("\n"+str(self.secondary_offset)+":")
-        print(self.secondary_block.hex())
+        print(format_partition(self.report()))
 
 
 
@@ -44,10 +204,16 @@ class GptHeader( object ):
     backup_lba=None
     entries_number=None
     entries_checksum=None
+    # first LBA of partition entries array
+    entries_lba=None
 
     gpt_header_offset=None
     partition_table=None
     partition_table_offset=None
+    # PartitionTableChecksum, see table_checksum()
+    partition_table_checksum=None
+    # collector of checksum timings (gpt_metrics), set by GptReader
+    metrics=NULL_METRICS
 
     def __init__( self, gpt_header, gpt_header_offset, partition_table, partition_table_offset ):
         self.gpt_header=gpt_header
@@ -56,6 +222,7 @@ class GptHeader( object ):
         self.checksum=self.gpt_header[0x10:0x10+4]
         self.current_lba=int.from_bytes(gpt_header[0x18:0x18+8],"little")
         self.backup_lba=int.from_bytes(gpt_header[0x20:0x20+8],"little")
+        self.entries_lba=int.from_bytes(gpt_header[0x48:0x48+8],"little")
         self.entries_number=int.from_bytes(gpt_header[0x50:0x50+4],"little")
         self.entries_checksum=self.gpt_header[0x58:0x58+4]
 
@@ -65,42 +232,41 @@ class GptHeader( object ):
         pass
 
     def calculate_checksum( self, gpt_header ):
-        header_size=int.from_bytes(gpt_header[0x0C:0x0C+4],"little")
-        # creation of gpt_header with zeroed checksum field
-        gpt_header_zero_cs=[ ]
-        gpt_header_zero_cs.append(gpt_header[0:0x10])
-        gpt_header_zero_cs.append(bytes(bytearray(4)))
-        gpt_header_zero_cs.append(gpt_header[0x14:header_size])
-        gpt_header_zero_cs=b''.join(gpt_header_zero_cs)
-        # checksum in big-endian
-        checksum=zlib.crc32(gpt_header_zero_cs)
+        # CRC32 of gpt_header with zeroed checksum field
+        with self.metrics.phase("checksum"):
+            checksum=header_crc32(gpt_header)
         # checksum in little-endian bytes
-        checksum=checksum.to_bytes((checksum.bit_length()+7)//8,"little")
-        return checksum
+        return checksum.to_bytes(4,"little")
 
     # partition table CRC32/zlib checksum
     def calculate_partition_table_checksum( self, partition_table ):
         # partition table checksum in big-endian
-        checksum=zlib.crc32(partition_table)
+        with self.metrics.phase("checksum"):
+            checksum=zlib.crc32(partition_table)
         # patition table checksum in little-endian bytes
-        checksum=checksum.to_bytes((checksum.bit_length()+7)//8,"little")
-        # return in bytes
-        return checksum
+        return checksum.to_bytes(4,"little")
+
+    # (header checksum is correct, partition table checksum is correct)
+    def validate( self ):
+        with self.metrics.phase("checksum"):
+            return validate_header(self)
+
+    # checksum engine of this partition table, created once per header
+    # so repeated edits of entries update table CRC incrementally
+    def table_checksum( self ):
+        if self.partition_table_checksum is None:
+            with self.metrics.phase("checksum"):
+                self.partition_table_checksum=PartitionTableChecksum(self.partition_table, self.entry_size)
+        return self.partition_table_checksum
+
+    # immutable copy of header with calculated checksums (gpt_report)
+    def report( self ):
+        return HeaderReport(self.gpt_header_offset, bytes(self.gpt_header), self.header_size,
+                            bytes(self.checksum), self.current_lba, self.backup_lba,
+                            self.entries_lba, self.entries_number, self.entry_size,
+                            self.partition_table_offset, bytes(self.entries_checksum),
+                            self.calculate_checksum(self.gpt_header),
+                            self.calculate_partition_table_checksum(self.partition_table))
 
     def print_info( self ):
-        print("\n\nGPT header ("+str(self.gpt_header_offset)+"): ")
-        print(self.gpt_header.hex())
-        print("Header size: "+str(self.header_size))
-        print("Checksum: "+self.checksum.hex())
-        print("Current LBA: "+str(self.current_lba))
-        print("Backup LBA: "+str(self.backup_lba))
-        print("Entries number: "+str(self.entries_number))
-        print("Entry size: "+str(self.entry_size))
-        print("Partition table offset: "+str(self.partition_table_offset))
-        print("Partition table checksum: "+self.entries_checksum.hex())
-
-        print("\nCalculated header checksum: "+self.calculate_checksum(self.gpt_header).hex())
-        print("Calculated partition table checksum: "+
-            self.calculate_partition_table_checksum(self.partition_table).hex())
-
-    
+        print(format_header(self.report()))
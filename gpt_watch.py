@@ -0,0 +1,377 @@
+# Watching GPT disks and serving their partitions over UNIX socket (for Python 3)
+# USAGE: sudo python3 gpt_watch.py [-s] [-i INTERVAL] [--poll] [--socket PATH] DIR|DISK_PATH|GLOB ...
+#        python3 gpt_watch.py [--socket PATH] -q '{"op":"guid","guid":"..."}'
+# One process keeps records of all disks in memory (as gpt_fleet.py prints them)
+# and reads a disk again only when its size, mtime or primary header checksums change.
+# Directories are watched with inotify, without it they are polled every INTERVAL
+#
+# Requests and responses are JSON lines:
+#   {"op":"list"}                       all records
+#   {"op":"disk","path":"/dev/sda"}     record of one disk
+#   {"op":"guid","guid":"..."}          disks with partition of this unique guid
+#   {"op":"stats"}                      number of disks and rescans
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import sys
+import json
+import stat
+import fnmatch
+import select
+import signal
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+import ctypes
+import ctypes.util
+
+from gpt_fleet import scan_disk
+from gpt_fleet import collect_paths
+from gpt_cache import default_cache_path
+from gpt_structures import unique_guid_key
+
+
+
+# inotify events of linux/inotify.h which can change the disk list or disks
+IN_MODIFY=0x00000002
+IN_ATTRIB=0x00000004
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_FROM=0x00000040
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_DELETE=0x00000200
+IN_NONBLOCK=0o4000
+WATCH_MASK=(IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE)
+# wd, mask, cookie, len of struct inotify_event
+EVENT_FORMAT="iIII"
+EVENT_SIZE=struct.calcsize(EVENT_FORMAT)
+
+
+
+def default_socket_path( ):
+    return os.path.join(os.path.dirname(default_cache_path()), "watch.sock")
+
+
+
+# directory and file name pattern of watched argument:
+# directory means all files in it, otherwise dirname of the glob
+def watch_target( pattern ):
+    if os.path.isdir(pattern):
+        return pattern, "*"
+    return os.path.dirname(pattern) or ".", os.path.basename(pattern)
+
+
+
+# inotify through ctypes, so no modules outside of standard library are needed
+# changed() returns names of files of watched directories which had events
+class Inotify( object ):
+
+    def __init__( self, directories ):
+        libc=ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd=libc.inotify_init1(IN_NONBLOCK)
+        if self.fd<0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # {watch descriptor:directory}
+        self.watches=dict()
+        for directory in directories:
+            wd=libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd<0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed for "+directory)
+            self.watches[wd]=directory
+
+    # waits up to timeout seconds, returns set of paths with events
+    def changed( self, timeout ):
+        paths=set()
+        ready, _, _ = select.select([self.fd], [ ], [ ], timeout)
+        if not ready:
+            return paths
+        while True:
+            try:
+                data=os.read(self.fd, 64*1024)
+            except BlockingIOError:
+                return paths
+            position=0
+            while position<len(data):
+                wd, mask, cookie, length = struct.unpack_from(EVENT_FORMAT, data, position)
+                name=data[position+EVENT_SIZE:position+EVENT_SIZE+length].rstrip(b"\0")
+                position+=EVENT_SIZE+length
+                if name and wd in self.watches:
+                    paths.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+
+    def close( self ):
+        os.close(self.fd)
+
+
+
+# fallback without inotify: every wait is a timeout, rescans find changes
+class Polling( object ):
+
+    def __init__( self, directories ):
+        self.event=threading.Event()
+
+    def changed( self, timeout ):
+        self.event.wait(timeout)
+        return set()
+
+    def close( self ):
+        pass
+
+
+
+# records of watched disks
+# disk is scanned again only when stat or primary header checksums changed
+class DiskIndex( object ):
+
+    def __init__( self, search_secret=False ):
+        self.search_secret=search_secret
+        # {path:{"identity", "checksums", "record", "json"}}
+        self.disks=dict()
+        # {partition unique guid (hex of raw bytes):set of paths}
+        self.guids=dict()
+        self.rescans=0
+        self.lock=threading.Lock()
+
+    # (device, inode, size, mtime) - block devices keep mtime on writes,
+    # for them checksums of primary header are compared too
+    @staticmethod
+    def identity( st ):
+        return (st.st_dev, st.st_ino, st.st_rdev, st.st_size, st.st_mtime_ns)
+
+    # stored checksums of primary header, read straight from LBA 1 of block device
+    @staticmethod
+    def header_checksums( path, lba_size ):
+        fd=os.open(path, os.O_RDONLY)
+        try:
+            header=os.pread(fd, lba_size, lba_size)
+        finally:
+            os.close(fd)
+        return header[0x10:0x14].hex()+header[0x58:0x5C].hex()
+
+    # scans disk if it is new or changed, removes it if it is gone
+    # returns True if index changed
+    def refresh( self, path ):
+        try:
+            st=os.stat(path)
+        except FileNotFoundError:
+            return self.remove(path)
+        if not (stat.S_ISREG(st.st_mode) or stat.S_ISBLK(st.st_mode)):
+            return False
+        identity=self.identity(st)
+        entry=self.disks.get(path)
+        checksums=None
+        if entry is not None and entry["identity"]==identity:
+            if not stat.S_ISBLK(st.st_mode) or not entry["record"].get("gpt"):
+                return False
+            try:
+                checksums=self.header_checksums(path, entry["record"]["lba_size"])
+            except OSError:
+                checksums=None
+            if checksums==entry["checksums"]:
+                return False
+
+        record=scan_disk(path, self.search_secret)
+        if stat.S_ISBLK(st.st_mode) and record.get("gpt"):
+            checksums=record["primary"]["checksum"]+record["primary"]["entries_checksum"]
+        self.store(path, {"identity":identity, "checksums":checksums, "record":record,
+                          "json":json.dumps(record)})
+        return True
+
+    def store( self, path, entry ):
+        with self.lock:
+            self.unindex(path)
+            self.disks[path]=entry
+            self.rescans+=1
+            for partition in entry["record"].get("partitions", [ ]):
+                self.guids.setdefault(partition["unique_guid"], set()).add(path)
+
+    def remove( self, path ):
+        with self.lock:
+            if path not in self.disks:
+                return False
+            self.unindex(path)
+            del self.disks[path]
+        return True
+
+    # removes guids of the disk from guid index, lock must be held
+    def unindex( self, path ):
+        entry=self.disks.get(path)
+        if entry is None:
+            return
+        for partition in entry["record"].get("partitions", [ ]):
+            paths=self.guids.get(partition["unique_guid"])
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self.guids[partition["unique_guid"]]
+
+    # response line for one request, records are serialized once when scanned
+    def query( self, request ):
+        op=request.get("op")
+        with self.lock:
+            if op=="list":
+                return "["+",".join(entry["json"] for entry in self.disks.values())+"]"
+            if op=="disk":
+                entry=self.disks.get(request.get("path"))
+                return entry["json"] if entry is not None else "null"
+            if op=="guid":
+                guid=unique_guid_key(str(request.get("guid", "")))
+                return "["+",".join(self.disks[path]["json"]
+                                     for path in sorted(self.guids.get(guid, ())))+"]"
+            if op=="stats":
+                return json.dumps({"disks":len(self.disks), "rescans":self.rescans,
+                                   "guids":len(self.guids)})
+        return json.dumps({"error":"unknown op "+str(op)})
+
+
+
+# one client connection: request lines in, response lines out
+class QueryHandler( socketserver.StreamRequestHandler ):
+
+    def handle( self ):
+        for line in self.rfile:
+            try:
+                request=json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be JSON object, not "+type(request).__name__)
+                response=self.server.index.query(request)
+            except ValueError as e:
+                response=json.dumps({"error":str(e)})
+            self.wfile.write(response.encode()+b"\n")
+            self.wfile.flush()
+
+
+
+class QueryServer( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+    daemon_threads=True
+
+    def __init__( self, socket_path, index ):
+        self.index=index
+        directory=os.path.dirname(socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.remove_stale_socket(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, QueryHandler)
+
+    # only socket of previous run which was killed is removed: path which is
+    # not a socket, or socket of running watcher, is never deleted
+    def remove_stale_socket( self, socket_path ):
+        try:
+            st=os.lstat(socket_path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(st.st_mode):
+            raise ValueError("Socket path "+socket_path+" is not a socket")
+        client=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+        finally:
+            client.close()
+        raise ValueError("Watcher is already running on "+socket_path)
+
+
+
+# watches patterns and keeps index up to date until stop is set
+# every interval all disks are checked again: new globs matches, block devices
+# changed without inotify events and everything in polling mode
+def watch( index, patterns, interval=5.0, poll=False, stop=None ):
+    stop=stop or threading.Event()
+    targets=[watch_target(pattern) for pattern in patterns]
+    directories=sorted(set(directory for directory, name in targets))
+    watcher=None
+    if not poll:
+        try:
+            watcher=Inotify(directories)
+        except (OSError, AttributeError) as e:
+            print("inotify is not available ("+str(e)+"), polling every "+str(interval)+" s", file=sys.stderr)
+    if watcher is None:
+        watcher=Polling(directories)
+    try:
+        while not stop.is_set():
+            paths=set(collect_paths([os.path.join(d, n) for d, n in targets]))
+            # disks which do not match patterns any more
+            for path in list(index.disks):
+                if path not in paths:
+                    index.remove(path)
+            for path in paths:
+                index.refresh(path)
+            # events until the next full check
+            waited=0.0
+            while waited<interval and not stop.is_set():
+                for path in watcher.changed(min(1.0, interval-waited)):
+                    directory, name = os.path.split(path)
+                    if any(d==directory and fnmatch.fnmatch(name, n) for d, n in targets):
+                        index.refresh(path)
+                waited+=min(1.0, interval-waited)
+    finally:
+        watcher.close()
+
+
+
+# sends one request to running watcher and returns response line
+def query( request, socket_path=None ):
+    client=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path or default_socket_path())
+        client.sendall(json.dumps(request).encode()+b"\n")
+        with client.makefile("rb") as file:
+            return file.readline().decode().rstrip("\n")
+    finally:
+        client.close()
+
+
+
+def main( args ):
+    parser=argparse.ArgumentParser(description="Watch GPT disks and answer queries over UNIX socket.")
+    parser.add_argument("paths", nargs="*", help="directories, disk paths or globs (/dev/sd?, images/*.img)")
+    parser.add_argument("-s", "--secret", action="store_true",
+                        help="search for partitions hidden by gpt_secret_partition")
+    parser.add_argument("-i", "--interval", type=float, default=5.0, help="seconds between full checks")
+    parser.add_argument("--poll", action="store_true", help="do not use inotify")
+    parser.add_argument("--socket", default=None,
+                        help="UNIX socket path (default: ~/.cache/gptutils/watch.sock)")
+    parser.add_argument("-q", "--query", default=None, help="send JSON request to running watcher")
+    options=parser.parse_args(args[1:])
+
+    if options.query is not None:
+        try:
+            print(query(json.loads(options.query), options.socket))
+        except (OSError, ValueError) as e:
+            print("Query failed: "+str(e))
+            exit(-1)
+        exit(0)
+    if not options.paths:
+        parser.print_usage()
+        exit(-1)
+
+    socket_path=options.socket or default_socket_path()
+    index=DiskIndex(options.secret)
+    try:
+        server=QueryServer(socket_path, index)
+    except (OSError, ValueError) as e:
+        print(str(e))
+        exit(-1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # service managers stop watcher with SIGTERM, socket must be removed then too
+    stop=threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        watch(index, options.paths, options.interval, options.poll, stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+    return None
+
+# need this if execution is not from import
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,209 @@
+# Transactional writes of GPT changes (for Python 3)
+# USAGE: see gpt_secret_partition.py
+# Changes are collected into a plan, merged and written in offset order
+# with one fsync. Original bytes are saved in undo journal first,
+# so interrupted run can be rolled back with rollback()
+#
+# Other GPT utilities https://github.com/DenisNovac/GPTUtils
+# Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
+
+import os
+import stat
+import zlib
+import bisect
+import struct
+
+from gpt_cache import disk_cache_path
+from gpt_metrics import NULL_METRICS
+from gpt_report import GptError
+from disk_source import image_format
+
+
+
+JOURNAL_MAGIC=b"GPTJRNL2"
+# device, inode, size of the disk and length of its path, path follows
+JOURNAL_DISK="<QQQH"
+# offset and length of every saved range
+JOURNAL_RANGE="<QI"
+
+
+
+# journals are kept next to the cache, not next to /dev/sdX,
+# because /dev does not survive reboot
+def default_journal_path( disk_path ):
+    return disk_cache_path("journal", disk_path, ".journal")
+
+
+
+# (path, device, inode, size) of the opened disk, journal is rolled back only on the same disk
+# inode of /dev node is new after reboot, so block devices are identified by st_rdev
+def disk_identity( fd, disk_path ):
+    st=os.fstat(fd)
+    size=os.lseek(fd, 0, os.SEEK_END)
+    if stat.S_ISBLK(st.st_mode):
+        return os.path.abspath(disk_path), st.st_rdev, 0, size
+    return os.path.abspath(disk_path), st.st_dev, st.st_ino, size
+
+
+
+def format_identity( identity ):
+    return "%s (device %d, inode %d, size %d)" % identity
+
+
+
+def fsync_directory( path ):
+    fd=os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+
+def write_all( fd, data, offset ):
+    view=memoryview(data)
+    while view:
+        written=os.pwritev(fd, [view], offset)
+        view=view[written:]
+        offset+=written
+
+
+
+# collection of byte-range changes of one disk
+# later changes of the same bytes win
+class WritePlan( object ):
+
+    def __init__( self ):
+        # [(offset, bytes)] in order of adding
+        self.changes=[ ]
+
+    def add( self, offset, data ):
+        if offset<0:
+            raise ValueError("Negative offset "+str(offset))
+        if len(data):
+            self.changes.append((offset, bytes(data)))
+
+    # overlapping and adjacent changes merged into [(offset, bytearray)] sorted by offset
+    def extents( self ):
+        extents=[ ]
+        for offset, data in sorted(self.changes, key=lambda change: change[0]):
+            if extents and offset<=extents[-1][0]+extents[-1][1]:
+                start=extents[-1][0]
+                extents[-1][1]=max(extents[-1][1], offset+len(data)-start)
+            else:
+                extents.append([offset, len(data)])
+        buffers=[(start, bytearray(length)) for start, length in extents]
+        starts=[start for start, length in extents]
+        # changes applied in order of adding, so later ones overwrite earlier
+        for offset, data in self.changes:
+            start, buffer=buffers[bisect.bisect_right(starts, offset)-1]
+            buffer[offset-start:offset-start+len(data)]=data
+        return buffers
+
+    # writes the plan: journal with original bytes, all extents, one fsync,
+    # then journal is removed. Returns list of written (offset, length)
+    # offsets are offsets of raw disk, so compressed images and containers
+    # are refused with GptError before anything is written
+    def commit( self, disk_path, journal_path=None, metrics=NULL_METRICS ):
+        extents=self.extents()
+        if not extents:
+            return [ ]
+        journal_path=journal_path or default_journal_path(disk_path)
+        with metrics.phase("write"):
+            fd=os.open(disk_path, os.O_RDWR)
+            try:
+                format=image_format(lambda offset, length: os.pread(fd, length, offset),
+                                    os.lseek(fd, 0, os.SEEK_END))
+                if format is not None:
+                    raise GptError(format+" image "+disk_path+" can not be changed in place")
+                write_journal(fd, journal_path, disk_identity(fd, disk_path), extents)
+                for offset, data in extents:
+                    write_all(fd, data, offset)
+                    metrics.io("write", offset, len(data))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.remove(journal_path)
+            fsync_directory(journal_path)
+        return [(offset, len(data)) for offset, data in extents]
+
+
+
+# saves identity of the disk and original bytes of every extent,
+# syncs journal before disk is changed
+def write_journal( fd, journal_path, identity, extents ):
+    path=os.fsencode(identity[0])
+    parts=[JOURNAL_MAGIC, struct.pack(JOURNAL_DISK, identity[1], identity[2], identity[3], len(path)), path,
+           struct.pack("<I", len(extents))]
+    for offset, data in extents:
+        parts.append(struct.pack(JOURNAL_RANGE, offset, len(data)))
+        parts.append(os.pread(fd, len(data), offset))
+    journal=b''.join(parts)
+    journal+=struct.pack("<I", zlib.crc32(journal))
+
+    os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+    temporary=journal_path+".tmp"
+    with open(temporary,"wb") as file:
+        file.write(journal)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, journal_path)
+    fsync_directory(journal_path)
+
+
+
+# reads journal, returns (identity, [(offset, original bytes)]) or None
+# if journal is incomplete (then disk was not touched yet)
+# journal of other format version is GptError, it must not be dropped as incomplete
+def read_journal( journal_path ):
+    with open(journal_path,"rb") as file:
+        journal=file.read()
+    if journal[:7]==JOURNAL_MAGIC[:7] and journal[:8]!=JOURNAL_MAGIC:
+        raise GptError("Journal "+journal_path+" has unknown format "+repr(journal[:8]))
+    header_size=len(JOURNAL_MAGIC)+struct.calcsize(JOURNAL_DISK)
+    if len(journal)<header_size+8 or not journal.startswith(JOURNAL_MAGIC):
+        return None
+    if zlib.crc32(journal[:-4])!=struct.unpack("<I", journal[-4:])[0]:
+        return None
+    dev, ino, size, path_length = struct.unpack_from(JOURNAL_DISK, journal, len(JOURNAL_MAGIC))
+    identity=(os.fsdecode(journal[header_size:header_size+path_length]), dev, ino, size)
+    count=struct.unpack_from("<I", journal, header_size+path_length)[0]
+    position=header_size+path_length+4
+    ranges=[ ]
+    for i in range(count):
+        offset, length = struct.unpack_from(JOURNAL_RANGE, journal, position)
+        position+=struct.calcsize(JOURNAL_RANGE)
+        ranges.append((offset, journal[position:position+length]))
+        position+=length
+    return identity, ranges
+
+
+
+# true if there is journal of unfinished plan for the disk
+def has_journal( disk_path, journal_path=None ):
+    return os.path.exists(journal_path or default_journal_path(disk_path))
+
+
+
+# restores bytes saved in journal of interrupted plan and removes journal
+# returns number of restored ranges; journal of other disk (other path, inode
+# or size) is refused with GptError and kept
+def rollback( disk_path, journal_path=None ):
+    journal_path=journal_path or default_journal_path(disk_path)
+    journal=read_journal(journal_path)
+    ranges=journal[1] if journal else None
+    if ranges:
+        fd=os.open(disk_path, os.O_RDWR)
+        try:
+            identity=disk_identity(fd, disk_path)
+            if identity!=journal[0]:
+                raise GptError("Journal "+journal_path+" is of "+format_identity(journal[0])
+                               +", not of "+format_identity(identity))
+            for offset, data in ranges:
+                write_all(fd, data, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    os.remove(journal_path)
+    fsync_directory(journal_path)
+    return len(ranges or [ ])
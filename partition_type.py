@@ -3,6 +3,10 @@
 # Other GPT utilities https://github.com/DenisNovac/GPTUtils
 # Documentation https://en.wikipedia.org/wiki/GUID_Partition_Table
 
+import os
+import sys
+import json
+import uuid
 from enum import Enum
 
 
@@ -33,10 +37,72 @@ class PartitionType(Enum):
     Reserved="8DA63339-0007-60C0-C436-083AC8230908"
 
     # returns string representation of partition type
+    # partition_guid is standard string or raw 16 bytes from disk
     @staticmethod
     def type( partition_guid ):
-        for e in PartitionType:
-            if e.value == partition_guid:
-                # only output type, not class name
-                return str(e).split("PartitionType.",1)[1]
-        return "Unknown"
\ No newline at end of file
+        if isinstance(partition_guid, str):
+            name=TYPES_BY_STRING.get(partition_guid)
+            if name is None:
+                name=TYPES_BY_STRING.get(partition_guid.upper(), "Unknown")
+            return name
+        return TYPES_BY_BYTES.get(bytes(partition_guid), "Unknown")
+
+
+
+# registry of known types: {guid string:name} and {raw on-disk guid:name}
+# lookups are single dict access no matter how many types are known
+TYPES_BY_STRING=dict()
+TYPES_BY_BYTES=dict()
+
+# list of files with extra types, separated as PATH
+# json files must contain {guid:name} object, other files - "GUID name" lines
+EXTENSIONS_VARIABLE="GPT_PARTITION_TYPES"
+
+
+
+# adds {guid string:name} types into registry, existing guids are renamed
+# guids can be in braces or lowercase, raises ValueError for broken guid
+def register_types( types ):
+    for guid, name in types.items():
+        guid=uuid.UUID(guid)
+        TYPES_BY_STRING[str(guid).upper()]=name
+        TYPES_BY_BYTES[guid.bytes_le]=name
+
+
+
+# reads extension table of types from file
+# every tool imports this module, so broken files and lines
+# are skipped with a warning instead of failing the import
+def load_types_file( path ):
+    entries=[ ]
+    try:
+        with open(path) as file:
+            if path.endswith(".json"):
+                types=json.load(file)
+                if not isinstance(types, dict):
+                    raise ValueError("not a {guid:name} object")
+                entries=[(guid, name, guid) for guid, name in types.items()]
+            else:
+                for number, line in enumerate(file, 1):
+                    text=line.split("#",1)[0].strip()
+                    if not text:
+                        continue
+                    guid, name = (text.split(None,1)+[None])[0:2]
+                    entries.append((guid, name and name.strip().replace(" ","_"), "line "+str(number)))
+    except (OSError, ValueError) as e:
+        print("Skipping partition types file "+path+": "+str(e), file=sys.stderr)
+        return
+    for guid, name, place in entries:
+        try:
+            if not isinstance(name, str):
+                raise ValueError("no type name")
+            register_types({guid:name})
+        except ValueError as e:
+            print("Skipping "+place+" of "+path+": "+str(e), file=sys.stderr)
+
+
+
+register_types({e.value:e.name for e in PartitionType})
+for path in os.environ.get(EXTENSIONS_VARIABLE,"").split(os.pathsep):
+    if path:
+        load_types_file(path)